@@ -1,9 +1,46 @@
 from mycroft import MycroftSkill, intent_file_handler
+from mycroft.messagebus.message import Message
 from datetime import datetime, timedelta, time, timezone, date
 import caldav
-import creds
 from mycroft.util.parse import extract_datetime
-import importlib
+from concurrent.futures import ThreadPoolExecutor, wait
+import functools
+import heapq
+import os
+import random
+import threading
+import uuid
+from .ical import parse_record
+from .journal import WriteQueue, DONE, FAILED, RETRY
+from .metrics import Metrics
+from .session import CalDavSession
+from .settings import CalendarSettings
+from .snapshot import Snapshot
+from .records import EventRecord, to_timestamp
+from .store import EventStore, WriteRejected
+
+# defaults for the background refresh of the event stores, all values in seconds
+REFRESH_INTERVAL = 300
+REFRESH_JITTER = 30
+MAX_STALENESS = 900
+# limits for answering from multiple calendars at once
+CALENDAR_WORKERS = 4
+CALENDAR_TIMEOUT = 10
+
+
+def traced_intent(name: str):
+    """Decorates an intent handler, so every run of it gets traced by the metrics of the skill.
+
+    Args:
+        name: A string containing the name of the intent.
+    """
+    def decorator(handler):
+        @functools.wraps(handler)
+        def traced(self, message):
+            with self.metrics.intent(name):
+                return handler(self, message)
+        return traced
+    return decorator
 
 
 class Nextcalendar(MycroftSkill):
@@ -17,73 +54,471 @@ class Nextcalendar(MycroftSkill):
     def __init__(self):
         """Inits class"""
         MycroftSkill.__init__(self)
+        # the nextcloud login and the used calendar, taken from the skill settings in initialize
+        self.calendar_settings = None
+        self.session = None
+        # local copies of the calendars events by the calendar url
+        self.stores = {}
+        self.stores_lock = threading.RLock()
+        # shared by all intents querying multiple calendars, so a slow calendar can't block the skill
+        self.pool = ThreadPoolExecutor(max_workers=CALENDAR_WORKERS)
+        # creations, modifications and deletions waiting to be sent to the server
+        self.writes = None
+        # copy of the discovered calendars and the stored events surviving restarts
+        self.snapshot = None
+        # latency of the intents and their stages
+        self.metrics = Metrics()
+
+
+    def initialize(self):
+        """Connects to the nextcloud from the skill settings and starts the background refresh, which keeps the
+        event store of the used calendar warm, and the worker sending the queued writes to the server.
+        """
+        self.calendar_settings = CalendarSettings(os.path.join(self.file_system.path, 'calendar.json'), self.settings)
+        self.settings_change_callback = self.on_settings_changed
+        self.metrics.listener = self.emit_metrics
+        self.metrics.profile_dir = self.file_system.path
+        self.apply_metrics_settings()
+        self.add_event('nextcalendar.metrics.get', self.handle_metrics_request)
+        self.add_event('nextcalendar.profile', self.handle_profile_request)
+        self.connect()
+        self.writes = WriteQueue(os.path.join(self.file_system.path, 'writes.db'), self.send_writes, self.log)
+        self.writes.start()
+        self.schedule_refresh(0)
+
+
+    def shutdown(self):
+        """Closes the connection to the CalDav server when the skill gets unloaded. Unsent writes stay queued until
+        the next start.
+        """
+        if self.writes is not None:
+            self.writes.stop()
+        if self.snapshot is not None:
+            try:
+                self.save_snapshot()
+            except Exception:
+                self.log.exception("Saving the calendar snapshot failed")
+            self.snapshot.close()
+        self.pool.shutdown(wait=False)
+        if self.session is not None:
+            self.session.close()
+
+
+    def connect(self):
+        """Opens the session to the nextcloud account from the settings and the snapshot of the account. The
+        calendars found by the last discovery are restored from the snapshot, so the first intent after a restart
+        doesn't wait for the discovery. The stores of an account used before are dropped.
+        """
+        with self.stores_lock:
+            if self.snapshot is not None:
+                try:
+                    self.save_snapshot()
+                except Exception:
+                    self.log.exception("Saving the calendar snapshot failed")
+                self.snapshot.close()
+            if self.session is not None:
+                self.session.close()
+            self.stores = {}
+            self.session = CalDavSession(self.calendar_settings.dav_url, self.metrics)
+            self.snapshot = Snapshot(os.path.join(self.file_system.path,
+                                                  f'snapshot-{self.calendar_settings.account}.db'))
+            discovery = self.snapshot.load_discovery()
+            if discovery is not None:
+                self.session.restore(*discovery)
+
+
+    def on_settings_changed(self):
+        """Takes over the changed skill settings. Connects again if the login changed and warms up the store of the
+        used calendar, which might have changed too.
+        """
+        if self.calendar_settings.update(self.settings):
+            self.connect()
+        self.apply_metrics_settings()
+        self.schedule_refresh(0)
+
+
+    def apply_metrics_settings(self):
+        """Switches the metrics file and the profiling of the next intent run on or off as set in the skill
+        settings."""
+        metrics_file = self.settings.get('metrics_file')
+        self.metrics.path = os.path.join(self.file_system.path, 'metrics.jsonl') if metrics_file else None
+        if self.settings.get('profile_next_intent'):
+            self.metrics.profile_next()
+
+
+    def emit_metrics(self, record: dict):
+        """Sends the timings of a finished intent run and the current latency percentiles over the message bus.
+
+		Args:
+			record: A dict containing the intent, its total duration and the durations of its stages.
+		"""
+        try:
+            self.bus.emit(Message('nextcalendar.metrics', dict(record, histograms=self.metrics.summary())))
+        except Exception:
+            self.log.exception("Sending the intent metrics failed")
+
+
+    def handle_metrics_request(self, message):
+        """Answers a request for the latency percentiles of the intents and their stages on the message bus."""
+        self.bus.emit(message.response({'histograms': self.metrics.summary()}))
+
+
+    def handle_profile_request(self, message):
+        """Profiles the next intent run with cProfile, the profile is written to the data directory of the skill."""
+        self.metrics.profile_next()
+
+
+    def get_response(self, *args, **kwargs):
+        """Asks the user and waits for the answer like MycroftSkill.get_response, the wait is traced as a stage."""
+        with self.metrics.span('get_response'):
+            return MycroftSkill.get_response(self, *args, **kwargs)
+
+
+    def schedule_refresh(self, delay: float = None):
+        """Schedules the next background refresh of the event stores, replacing a scheduled one. The refresh interval
+        and a random jitter, which keeps multiple devices from hitting the server at the same time, are taken from the
+        skill settings.
+
+        Args:
+            delay: Optional; A float containing the seconds until the refresh. Defaults to the refresh interval.
+        """
+        if delay is None:
+            delay = float(self.settings.get('refresh_interval') or REFRESH_INTERVAL)
+            delay += random.uniform(0, float(self.settings.get('refresh_jitter') or REFRESH_JITTER))
+        # mycroft adds a new event instead of replacing the one with the same name, which would start another chain
+        # of refreshes on every settings change
+        self.cancel_scheduled_event('RefreshStores')
+        self.schedule_event(self.refresh_stores, delay, name='RefreshStores')
+
+
+    def refresh_stores(self, message=None):
+        """Syncs the event store of the used calendar and all other stores in the background, so the read intents can
+        answer without waiting for the server. Schedules the next refresh afterwards.
+        """
+        try:
+            name = self.calendar_settings.calendar
+            calendar = None if name is None else self.session.calendar(name)
+            if calendar is not None:
+                self.get_store(calendar)
+            for store in list(self.stores.values()):
+                store.sync()
+            self.save_snapshot()
+        except Exception:
+            self.log.exception("Background refresh of the calendar failed")
+        finally:
+            self.schedule_refresh()
+
+
+    def save_snapshot(self):
+        """Writes the discovered calendars and the changes of the synced event stores to the snapshot."""
+        if self.snapshot is None:
+            return
+        discovery = self.session.discovery()
+        if discovery is not None:
+            self.snapshot.save_discovery(*discovery)
+        for store in list(self.stores.values()):
+            # a store which was never synced doesn't know all events of its calendar yet
+            if store.age() is None:
+                continue
+            sync_token, ctag, age, records, removed = store.take_changes()
+            self.snapshot.save_calendar(store.calendar.url.path, sync_token, ctag, age, records, removed)
+
+
+    def get_max_staleness(self):
+        """Gets the maximum age of the stored events, up to which the intents answer without syncing the store first.
+
+        Returns:
+            A float containing the maximum age in seconds.
+        """
+        return float(self.settings.get('max_staleness') or MAX_STALENESS)
 
 
     def get_calendars(self):
-        """Gets calendars from CalDav-Url. Creates the used caldav-url by joining the user, password and url values
-        stored in the creds.py file in the mycroft-core directory.
+        """Gets calendars from the CalDav session. The calendars are discovered on first use and cached afterwards.
 
 		Returns:
 			A list of calendars.
 		"""
-        # combining the username, password and nextcloud url (saved in local creds file)
-        url = f"https://{creds.user}:{creds.pw}@{creds.url}/nc/remote.php/dav"
-        client = caldav.DAVClient(url)
-        principal = client.principal()
-        calendars = principal.calendars()
-        return calendars
+        return self.session.calendars()
 
 
     def get_calendar(self):
-        """Gets calendar from calendars list by filtering for the name value set in the creds file.
+        """Gets calendar from calendars list by filtering for the name of the used calendar from the settings.
         Asks the user for another calendar name, if no fitting calendar was found
 
 		Returns:
 			A calendar containing the correct name attribute.
 		"""
-        calendars = self.get_calendars()
-        # search for first occuring calendar object in list containing the correct name value
-        calendar = next((cal for cal in calendars if cal.name.lower() == creds.cal_name.lower()), None)
+        # search for the calendar object containing the correct name value
+        name = self.calendar_settings.calendar
+        calendar = None if name is None else self.session.calendar(name)
         if calendar is None:
-            self.change_calendar(f"You don't have an calendar called {creds.cal_name}; "
+            self.change_calendar(f"You don't have an calendar called {name}; "
                                  f"Please tell me another existing calendar name")
-        else:
-            return calendar
+            calendar = self.session.calendar(self.calendar_settings.calendar)
+        return calendar
+
+
+    def get_store(self, calendar: caldav.objects.Calendar):
+        """Gets the local event store of the given calendar. Creates the store on first use and fills it with the
+        events saved in the snapshot, which get synced only once they are older than the maximum staleness.
+
+		Args:
+			calendar: A calendar object where the events are stored.
+
+		Returns:
+			The event store of the calendar.
+		"""
+        with self.stores_lock:
+            store = self.stores.get(str(calendar.url))
+            if store is None:
+                store = EventStore(self.session, calendar, self.log)
+                # writes left over from the last run must not be undone by the first sync
+                if self.writes is not None:
+                    store.pending.update(self.writes.pending(str(calendar.url)))
+                saved = None if self.snapshot is None else self.snapshot.load_calendar(calendar.url.path)
+                if saved is not None:
+                    store.load(*saved)
+                self.stores[str(calendar.url)] = store
+            return store
+
+
+    def get_store_by_url(self, url: str):
+        """Gets the local event store of the calendar with the given url.
+
+		Args:
+			url: A string containing the url of the calendar.
+
+		Returns:
+			The event store of the calendar or None if the user has no such calendar anymore.
+		"""
+        store = self.stores.get(url)
+        if store is None:
+            calendar = next((cal for cal in self.get_calendars() if str(cal.url) == url), None)
+            if calendar is not None:
+                store = self.get_store(calendar)
+        return store
+
+
+    def queue_write(self, store: EventStore, kind: str, href: str, payload: dict):
+        """Queues a write of an event to be sent to the server in the background. The local version of the event
+        has to be updated already and is kept until the write was sent.
+
+		Args:
+			store: The event store of the calendar containing the event.
+			kind: A string containing the kind of the write (create, modify or delete).
+			href: A string containing the href of the event.
+			payload: A dict containing the data needed to send the write.
+		"""
+        self.queue_writes(store, kind, [(href, payload)])
+
+
+    def queue_writes(self, store: EventStore, kind: str, writes):
+        """Queues multiple writes of the same kind at once, so the worker sends them together and their refused
+        writes get reported in one summary.
+
+		Args:
+			store: The event store of the calendar containing the events.
+			kind: A string containing the kind of the writes (create, modify or delete).
+			writes: A list of tuples containing the href of the event and the payload of the write.
+		"""
+        for href, _ in writes:
+            store.hold(href)
+        self.writes.push_many(str(store.calendar.url), kind, writes)
+
+
+    def send_writes(self, writes):
+        """Sends queued writes to the server. Gets called by the worker of the write queue. Deletions of the same
+        calendar are sent at the same time. The user is told about writes the server refused.
+
+		Args:
+			writes: A list of the due writes.
+
+		Returns:
+			A list containing DONE, FAILED or RETRY for each write.
+		"""
+        results = {}
+        deletions = {}
+        for write in writes:
+            store = self.get_store_by_url(write.calendar)
+            if store is None:
+                results[write.id] = FAILED
+            elif write.kind == 'delete':
+                deletions.setdefault(write.calendar, []).append(write)
+            else:
+                results[write.id] = self.send_write(store, write)
+
+        for url, calendar_writes in deletions.items():
+            deleted, failed, retry = self.get_store_by_url(url).delete_many(
+                [(write.href, write.payload.get('etag')) for write in calendar_writes])
+            for write in calendar_writes:
+                results[write.id] = RETRY if write.href in retry else FAILED if write.href in failed else DONE
+
+        failed_writes = []
+        for write in writes:
+            if results[write.id] == RETRY and write.last_attempt:
+                # the queue gives the write up, so the user has to be told like for a refused one
+                results[write.id] = FAILED
+            store = self.stores.get(write.calendar)
+            if results[write.id] != RETRY and store is not None:
+                store.release(write.href)
+            if results[write.id] == FAILED:
+                failed_writes.append(write)
+                if store is not None:
+                    store.refresh(write.href)
+
+        # one summary for all refused writes, e.g. of a bulk deletion
+        if len(failed_writes) == 1:
+            self.speak(f"Sorry, I couldn't {failed_writes[0].kind} your appointment "
+                       f"{failed_writes[0].payload.get('summary')} in your calendar. It might have been changed in "
+                       f"the meantime.")
+        elif len(failed_writes) > 1:
+            self.speak(f"Sorry, {len(failed_writes)} of your appointments couldn't be changed in your calendar. They "
+                       f"might have been changed in the meantime.")
+        return [results[write.id] for write in writes]
+
+
+    def send_write(self, store: EventStore, write):
+        """Sends a queued creation or modification of an event to the server.
+
+		Args:
+			store: The event store of the calendar containing the event.
+			write: The queued write.
 
+		Returns:
+			DONE, FAILED or RETRY.
+		"""
+        try:
+            if write.kind == 'create':
+                store.create(write.href, write.payload['data'])
+            else:
+                changes = {key: value if key == 'name' else datetime.fromisoformat(value)
+                           for key, value in write.payload['changes'].items()}
+                store.save(write.href, changes, write.payload.get('etag'), write.payload.get('original'))
+            return DONE
+        except WriteRejected:
+            return FAILED
+        except Exception:
+            self.log.exception(f"Couldn't {write.kind} {write.href}, trying again later")
+            return RETRY
+
+
+    def get_events_on_day(self, calendar: caldav.objects.Calendar, day: date):
+        """Finds all events starting at the given day.
+
+		Args:
+			calendar: A calendar object where the events are stored.
+			day: A date object representing the day.
 
-    def get_events(self, calendar: caldav.objects.Calendar, start: datetime = None, end: datetime = None):
-        """Finds all events starting between start and end time from the given calendar object.
-        The method also compares the time values of the start and end parameters
+		Returns:
+			 A list of the event records starting at the day sorted by their start.
+		"""
+        store = self.get_store(calendar)
+        store.sync_if_stale(self.get_max_staleness())
+        with self.metrics.span('filter'):
+            return store.events_on(day)
+
+
+    def get_next_events(self, calendar: caldav.objects.Calendar, after: datetime):
+        """Finds the next events starting after the given time. If multiple events share the earliest start date, all
+        of them are returned.
 
 		Args:
 			calendar: A calendar object where the events are stored.
-			start: Optional; A datetime object representing the minimal value for the startdate attribute.
-			end: Optional; A datetime object representing the maximum value for the startdate attribute.
+			after: A datetime object representing the minimal value for the startdate attribute.
 
 		Returns:
-			 A list of the events in the given time span.
+			 A list of the event records starting at the earliest start date.
 		"""
-        if start is None:
-            return calendar.events()
-        if start is not None:
+        store = self.get_store(calendar)
+        store.sync_if_stale(self.get_max_staleness())
+        with self.metrics.span('filter'):
+            return store.earliest_events(after)
+
+
+    def find_events(self, calendar: caldav.objects.Calendar, name: str):
+        """Finds the events whose name is similar to the given name in the local store. If the store isn't warm, the
+        name is searched on the server first, so only the matching events get transferred. The whole calendar only
+        gets synced if the server doesn't know the name, since it might have been misheard.
+
+		Args:
+			calendar: A calendar object where the events are stored.
+			name: A string containing the name to search for.
+
+		Returns:
+			 A list of the found event records with the most similar name first.
+		"""
+        store = self.get_store(calendar)
+        age = store.age()
+        if age is None or age > self.get_max_staleness():
+            if len(store.search(name)) == 0:
+                store.sync()
+        with self.metrics.span('filter'):
+            return store.find(name)
+
+
+    def get_query_calendars(self, message):
+        """Gets the calendars a read intent should be answered from. These are all calendars, if the user asked for
+        all of them or set the calendar selection in the skill settings to "all". Otherwise the used calendar and the
+        comma separated calendar names from the skill settings are taken.
+
+		Args:
+			message: The message object of the intent.
+
+		Returns:
+			A list of calendars.
+		"""
+        utterance = ' ' + message.data.get('utterance', '').lower() + ' '
+        selection = (self.settings.get('query_calendars') or '').strip().lower()
+        if ' all calendars ' in utterance or ' all my calendars ' in utterance or selection == 'all':
+            return self.get_calendars()
+
+        calendars = [self.get_calendar()]
+        for name in selection.split(','):
+            calendar = self.session.calendar(name.strip()) if name.strip() else None
+            if calendar is not None and calendar not in calendars:
+                calendars.append(calendar)
+        return calendars
+
+
+    def query_calendars(self, calendars, query):
+        """Runs a query on multiple calendars at the same time and merges the found event records by their start.
+        Calendars which fail or don't answer in time are skipped, so the others can still be used for the answer.
 
-            date_events = calendar.date_search(start=start, end=end) # get events between dates
-            filtered_events = []
+		Args:
+			calendars: A list of calendars to query.
+			query: A function taking a calendar and returning a list of event records sorted by their start.
+
+		Returns:
+			A tuple containing the merged list of event records and a list of the names of the failed calendars.
+		"""
+        if len(calendars) == 1:
+            return query(calendars[0]), []
+
+        futures = {self.pool.submit(self.metrics.bind(query), calendar): calendar for calendar in calendars}
+        done, not_done = wait(futures, timeout=CALENDAR_TIMEOUT)
+
+        results = []
+        failed = [futures[future].name for future in not_done]
+        for future in done:
+            if future.exception() is not None:
+                self.log.warning(f"Couldn't query calendar {futures[future].name}: {future.exception()}")
+                failed.append(futures[future].name)
+            else:
+                results.append(future.result())
+        return list(heapq.merge(*results, key=lambda ev: ev.start)), failed
 
-            # compare time sensitive
-            for ev in date_events:
-                ev_start = ev.instance.vevent.dtstart.value
-                # handling date objects, changing them to datetime to allow comparisons
-                if not isinstance(ev_start, datetime):
-                    ev.instance.vevent.dtstart.value = datetime.combine(ev_start, datetime.min.time())
 
-                if ev.instance.vevent.dtstart.value.astimezone() >= start.astimezone():
-                    filtered_events.append(ev)
+    def speak_failed_calendars(self, failed):
+        """Tells the user which calendars couldn't be used for the answer.
 
-            if end is not None:
-                filtered_events = [i for i in filtered_events if
-                                   i.instance.vevent.dtstart.value.astimezone() <= end.astimezone()]
-            return filtered_events
+		Args:
+			failed: A list containing the names of the failed calendars.
+		"""
+        if len(failed) == 1:
+            self.speak(f"I couldn't check your calendar {failed[0]} in time.")
+        elif len(failed) > 1:
+            self.speak(f"I couldn't check your calendars {', '.join(failed[:-1])} and {failed[-1]} in time.")
 
 
     def get_datetime_from_user(self, response_text: str):
@@ -99,48 +534,104 @@ class Nextcalendar(MycroftSkill):
         if user_input is None:
             return self.get_datetime_from_user("Couldnt understand the time stamp. Please try again")
 
-        extracted_datetime = extract_datetime(user_input)
+        with self.metrics.span('extract_datetime'):
+            extracted_datetime = extract_datetime(user_input)
         if extracted_datetime is None:
             return self.get_datetime_from_user("Couldnt understand the time stamp. Please try again")
         else:
             return extracted_datetime[0]
 
 
-    def modify_event(self, to_edit_event: caldav.objects.Event):
-        """Modifies an event object by taking inputs from the user. Asks the user which attributes should get changed
-        by which values.
+    def modify_event(self, to_edit_event: EventRecord, changes: dict = None):
+        """Collects the changes of an event by taking inputs from the user. Asks the user which attributes should get
+        changed by which values. Nothing is saved yet, so all changes can be sent to the server at once.
+
+		Args:
+			to_edit_event: A event record representing the event that should be modified.
+			changes: Optional; A dict containing the changes collected so far.
 
-		Args: A event object representing the event object that should be modified.
+		Returns:
+			A dict containing the new values by the changed attribute (start, end or name).
 		"""
-        change_att = self.get_response(f"Using appointment {to_edit_event.instance.vevent.summary.value}; "
+        if changes is None:
+            changes = {}
+        change_att = self.get_response(f"Using appointment {changes.get('name', to_edit_event.summary)}; "
                                        f"Which attribute do you want to change?")
         change_att = ' ' + change_att + ' '
 
         if " start " in change_att:
-            to_edit_event.instance.vevent.dtstart.value = self.get_datetime_from_user("When should it start?")
-            to_edit_event.save()
-            self.speak(f"Successfully modified your appointment")
+            changes['start'] = self.get_datetime_from_user("When should it start?")
         elif " end " in change_att:
-            to_edit_event.instance.vevent.dtend.value = self.get_datetime_from_user("When should it end?")
-            to_edit_event.save()
-            self.speak(f"Successfully modified your appointment")
+            changes['end'] = self.get_datetime_from_user("When should it end?")
         elif " name " in change_att:
-            name = self.get_response("How should I call it?")
-            to_edit_event.instance.vevent.summary.value = name
-            to_edit_event.save()
-            self.speak(f"Successfully modified your appointment")
+            changes['name'] = self.get_response("How should I call it?")
         else:
             self.speak("Sorry I can only modify the start, end and name attribute.")
         again = self.get_response(f"Do you want to change another attribute?")
         again = ' ' + again + ' '
         if " yes " in again or " sure " in again:
-            self.modify_event(to_edit_event)
+            return self.modify_event(to_edit_event, changes)
+        return changes
+
+
+    def save_event(self, calendar: caldav.objects.Calendar, to_edit_event: EventRecord, changes: dict):
+        """Saves all changes of an event at once. The changes are sent to the server in the background with a single
+        request.
+
+		Args:
+			calendar: A calendar object where the event is stored.
+			to_edit_event: A event record representing the modified event.
+			changes: A dict containing the changes collected by modify_event.
+		"""
+        if len(changes) == 0:
+            return
+        store = self.get_store(calendar)
+        # the values the user saw, so the server version can be checked for changes made during the dialog
+        edited = store.get(to_edit_event.href) or to_edit_event
+        original = {key: value for key, value in
+                    (('start', edited.start), ('end', edited.end), ('name', edited.summary)) if key in changes}
+        # the local version is updated at once, the server gets the changes in the background
+        name = changes.get('name', to_edit_event.summary)
+        # a moved recurring event is kept as single event until the server sent its new recurrence
+        store.put(EventRecord(to_timestamp(changes['start']) if 'start' in changes else to_edit_event.start,
+                              to_timestamp(changes['end']) if 'end' in changes else to_edit_event.end,
+                              to_edit_event.all_day, name, to_edit_event.uid, to_edit_event.href, to_edit_event.etag,
+                              None if 'start' in changes else to_edit_event.recurrence, to_edit_event.overrides))
+        self.queue_write(store, 'modify', to_edit_event.href,
+                         {'changes': {key: value if key == 'name' else value.isoformat()
+                                      for key, value in changes.items()}, 'summary': name,
+                          'etag': to_edit_event.etag, 'original': original})
+        self.speak(f"Successfully modified your appointment")
+
+
+    def delete_event(self, store: EventStore, to_delete_event: EventRecord):
+        """Deletes an event from the local store at once and queues its deletion on the server.
+
+		Args:
+			store: The event store of the calendar containing the event.
+			to_delete_event: A event record representing the event to delete.
+		"""
+        self.delete_events(store, [to_delete_event])
+
+
+    def delete_events(self, store: EventStore, to_delete_events):
+        """Deletes events from the local store at once and queues their deletions on the server together, so they
+        are sent at the same time and the refused ones get reported in one summary.
+
+		Args:
+			store: The event store of the calendar containing the events.
+			to_delete_events: A list of event records representing the events to delete.
+		"""
+        for event in to_delete_events:
+            store.remove(event.href)
+        self.queue_writes(store, 'delete', [(event.href, {'etag': event.etag, 'summary': event.summary})
+                                            for event in to_delete_events])
 
 
     def change_calendar(self, response_text: str, cal_name:str = None):
-        """Changes the used calendar from nextcloud on which the actions of the functions are performed
-		by changing and saving the cal_name value in the creds file and reimporting it. Reimports the creds file for
-		further use in other methods.
+        """Changes the used calendar from nextcloud on which the actions of the functions are performed.
+		The name is checked against the calendars known to the session, so no discovery is needed, and saved in the
+		settings. The event store of the calendar stays warm, if it was used before, or gets filled in the background.
 		Repeats itself if no calendar object with the given name exists.
 
 		Args:
@@ -149,18 +640,13 @@ class Nextcalendar(MycroftSkill):
         if cal_name is None:
             cal_name = self.get_response(response_text)
 
-        if next((cal for cal in self.get_calendars() if cal.name.lower() == cal_name.lower()), None) is None:
+        calendar = self.session.calendar(cal_name)
+        if calendar is None:
             self.change_calendar(f"You don't have an calendar called {cal_name}; "
                                  f"Please tell me another existing calendar name")
         else:
-            creds_file = open("creds.py", "r")
-            list_of_lines = creds_file.readlines()
-            list_of_lines[3] = f"cal_name = '{cal_name}'"
-
-            creds_file = open("creds.py", "w")
-            creds_file.writelines(list_of_lines)
-            creds_file.close()
-            importlib.reload(creds)
+            self.calendar_settings.select(calendar.name)
+            self.pool.submit(lambda: self.get_store(calendar).sync_if_stale(self.get_max_staleness()))
             self.speak(f"Successfully changed to calendar {cal_name}")
 
 
@@ -178,7 +664,8 @@ class Nextcalendar(MycroftSkill):
         """
         extracted_datetime = message.data.get(attribute_name)
         if extracted_datetime is not None:
-            extracted_datetime = extract_datetime(extracted_datetime)[0]
+            with self.metrics.span('extract_datetime'):
+                extracted_datetime = extract_datetime(extracted_datetime)[0]
             if extracted_datetime is None:
                 extracted_datetime = self.get_datetime_from_user(f"Couldn't understand the date; Please repeat.")
         else:
@@ -222,17 +709,29 @@ class Nextcalendar(MycroftSkill):
 
 
     def search_event_in_list(self, event_list, selected_name: str):
-        """ Searches for events in list containing the given name attribute. If multiple matches are found mycroft will
+        """ Searches for events in list containing the given name attribute. If no event has exactly this name, mycroft
+        offers the most similar name, which comes first in the list. If multiple matches are found mycroft will
         ask for the start and end attribute to find a single match.
 
         Args:
-            event_list: A list containing event objects which should get filtered
+            event_list: A list containing event records which should get filtered
             selected_name: String containing the name to be searched for
 
         Returns:
-            A list containing the event object matching the searched attributes
+            A list containing the event records matching the searched attributes
         """
-        event_list = [ev for ev in event_list if ev.instance.vevent.summary.value.lower() == selected_name.lower()]
+        selected_name_lower = selected_name.lower()
+        matches = [ev for ev in event_list if ev.summary_lower == selected_name_lower]
+
+        # the name might have been misheard, so offering the most similar one saves asking for the name again
+        if len(matches) == 0 and len(event_list) > 0:
+            similar = self.get_response(f"Can't find an appointment called {selected_name}; "
+                                        f"Do you mean {event_list[0].summary}?")
+            similar = ' ' + (similar or '') + ' '
+            if " yes " in similar or " sure " in similar:
+                selected_name = event_list[0].summary
+                matches = [ev for ev in event_list if ev.summary_lower == event_list[0].summary_lower]
+        event_list = matches
 
         # checking if one, none or multiple matches are found and handling the different szenarios
         if len(event_list) == 0:
@@ -243,8 +742,7 @@ class Nextcalendar(MycroftSkill):
         elif len(event_list) > 1:
             to_select_start = self.get_datetime_from_user(f"Found multiple appointments called {selected_name};"
                 f" Tell me on what date and time the appointment starts, which should be used.").astimezone()
-            to_select_events = [ev for ev in event_list if ev.instance.vevent.dtstart.value.astimezone()
-                                == to_select_start]
+            to_select_events = [ev for ev in event_list if ev.start == to_select_start.timestamp()]
             if len(to_select_events) == 0:
                 self.speak(f"Can't find an appointment called {selected_name} at "
                            f"{self.get_message_from_date(to_select_start)}.")
@@ -255,8 +753,7 @@ class Nextcalendar(MycroftSkill):
                 to_select_end = self.get_datetime_from_user(f"Found multiple appointments called {selected_name} "
                     f"starting at the same time; Tell me on what date and time the appointment, which should be used, "
                                                             f"ends.").astimezone()
-                to_select_events = [ev for ev in event_list if ev.instance.vevent.dtend.value.astimezone()
-                                    == to_select_end]
+                to_select_events = [ev for ev in event_list if ev.end == to_select_end.timestamp()]
                 if len(to_select_events) == 0:
                     self.speak(f"Can't find an appointment called {selected_name} starting at "
                                f"{self.get_message_from_date(to_select_start)} and ending at "
@@ -270,6 +767,7 @@ class Nextcalendar(MycroftSkill):
 
 
     @intent_file_handler('change.intent')
+    @traced_intent('change')
     def handle_change(self, message):
         """Changes the used calendar name by callling the change calendar method.
         Gets executed after user inputs, which ask mycroft to change the calendar.
@@ -279,44 +777,42 @@ class Nextcalendar(MycroftSkill):
 
 
     @intent_file_handler('nextcalendar.intent')
+    @traced_intent('nextcalendar')
     def handle_nextcalendar(self, message):
         """Informs the User about the next upcoming event(s).
         Gets executed after user inputs, which ask mycroft to inform the user about his next appointment.
 		"""
-        calendar = self.get_calendar()
+        calendars = self.get_query_calendars(message)
+        now = datetime.now().astimezone()
 
-        # get list of all upcoming events
-        future_events = self.get_events(calendar, datetime.now().astimezone())
+        # get list of all appointments with the earliest upcoming start date
+        next_appointments, failed = self.query_calendars(calendars, lambda cal: self.get_next_events(cal, now))
+        if len(next_appointments) > 0:
+            next_appointments = [ev for ev in next_appointments if ev.start == next_appointments[0].start]
 
-        if (len(future_events) == 0):
+        if (len(next_appointments) == 0):
             self.speak("You haven't got an upcoming appointment")
         else:
-            # sort events by their start date
-            future_events.sort(key=lambda x: x.instance.vevent.dtstart.value.astimezone())
-
             # getting the earliest event and its important values
-            earliest_appointment = future_events[0].instance.vevent
-            start = (earliest_appointment.dtstart.value)
-            summary = (earliest_appointment.summary.value)
-
-            # get list of all appointments with the earliest start date
-            next_appointments = [i for i in future_events if
-                                 i.instance.vevent.dtstart.value.astimezone() == start.astimezone()]
+            earliest_appointment = next_appointments[0]
+            start = earliest_appointment.start_datetime
+            summary = earliest_appointment.summary
 
             # check whether mulltiple appointments start at the date and create according answers
             if len(next_appointments) > 1:
-                first_appointments_string = " ".join(x.instance.vevent.summary.value + ", "
-                                                     for x in next_appointments[:-1])
+                first_appointments_string = " ".join(x.summary + ", " for x in next_appointments[:-1])
 
                 self.speak(f"You've got multiple next appointments, which are starting at "
                            f"{self.get_message_from_date(start)} and are entitled {first_appointments_string}and "
-                           f"{next_appointments[-1].instance.vevent.summary.value}.")
+                           f"{next_appointments[-1].summary}.")
             else:
                 output = f"Your next appointment is on {self.get_message_from_date(start)} and is entitled {summary}."
                 self.speak(output)
+        self.speak_failed_calendars(failed)
 
 
     @intent_file_handler('create.intent')
+    @traced_intent('create')
     def handle_create(self, message):
         """Creates an event with given name, start date and end date. Asks for the attribute values, if they are not
         contained in the message object.
@@ -333,10 +829,14 @@ class Nextcalendar(MycroftSkill):
             .strftime("%Y%m%dT%H%M%S")
         createdate = datetime.now().strftime("%Y%m%dT%H%M%S")
 
+        uid = str(uuid.uuid4())
+        href = f"{calendar.url.path.rstrip('/')}/{uid}.ics"
+
         # summarize all information in a string to add the new event
         new_event = f"""BEGIN:VCALENDAR
 VERSION:2.0
 BEGIN:VEVENT
+UID:{uid}
 DTSTAMP:{createdate}
 DTSTART:{startdate}
 DTEND:{enddate}
@@ -345,92 +845,94 @@ END:VEVENT
 END:VCALENDAR
 """
 
-        calendar.add_event(new_event)
+        # the event is visible locally at once, the server gets it in the background
+        store = self.get_store(calendar)
+        store.put(parse_record(new_event, href))
+        self.queue_write(store, 'create', href, {'data': new_event, 'summary': name})
         self.speak(f"Succesfully created a new event called {name}")
 
 
     @intent_file_handler('delete.intent')
+    @traced_intent('delete')
     def handle_delete(self, message):
         """Deletes an event with given name. Uses the search event in list to find the correct event by asking for
         more attributes if necessary. If multiple matches are found mycroft asks the user how my should get deleted.
         Gets executed after user inputs, which ask mycroft to delete an appointment.
 		"""
         calendar = self.get_calendar()
-        future_events = self.get_events(calendar)
+        store = self.get_store(calendar)
 
         # get the name of the event from message or ask the user if the message doesnt contain the name
         to_delete_name = self.get_name_from_message(message, 'to_delete_name')
+        future_events = self.find_events(calendar, to_delete_name)
 
         to_delete_events = self.search_event_in_list(future_events, to_delete_name)
 
         if len(to_delete_events)==1:
-            to_delete_events[0].delete()
+            self.delete_event(store, to_delete_events[0])
             self.speak("Successfully deleted the event")
         elif len(to_delete_events)>1:
             del_all = self.get_response("Should I delete all, one or none?")
             del_all = ' ' + del_all + ' '
 
             if ' all ' in del_all:
-                for ev in to_delete_events:
-                    ev.delete()
+                # the deletions are sent together, refused ones are reported in one summary afterwards
+                self.delete_events(store, to_delete_events)
                 self.speak("Okay I deleted all found events")
             elif ' one ' in del_all or ' 1 ' in del_all:
-                to_delete_events[0].delete()
+                self.delete_event(store, to_delete_events[0])
                 self.speak("Okay I deleted one of them")
             elif ' none ' in del_all:
                 self.speak("ok, I won't delete any of them.")
 
 
     @intent_file_handler("modify.intent")
+    @traced_intent('modify')
     def handle_modify(self, message):
         """Modifies an event with given name. Uses the search event in list to find the correct event by asking for
         more attributes if necessary.
 		Gets executed after user inputs, which ask mycroft to modify an existing appointment.
 		"""
         calendar = self.get_calendar()
-        future_events = self.get_events(calendar)
 
         # asks user for the event name
         to_edit_name = self.get_name_from_message(message, "to_edit_name")
+        future_events = self.find_events(calendar, to_edit_name)
 
         to_edit_events = self.search_event_in_list(future_events, to_edit_name)
 
+        # only the selected event gets downloaded and parsed completely, when the changes are saved
         if len(to_edit_events)==1:
-            self.modify_event(to_edit_events[0])
+            self.save_event(calendar, to_edit_events[0], self.modify_event(to_edit_events[0]))
         elif len(to_edit_events)>1:
             self.speak("I will modify one of them. If you want to delete the other one, you can ask me later.")
-            self.modify_event(to_edit_events[0])
+            self.save_event(calendar, to_edit_events[0], self.modify_event(to_edit_events[0]))
 
 
     @intent_file_handler("getday.intent")
+    @traced_intent('getday')
     def handle_getday(self, message):
         """Informs the user of the events on a specific day.
         Gets executed after user inputs, which ask mycroft for appointments on a specific date.
         """
-        calendar = self.get_calendar()
+        calendars = self.get_query_calendars(message)
 
         to_get_date = self.extract_datetime_from_message(message, 'date', 'At what day?')
 
-        starttime = to_get_date.replace(hour=0, minute=0, second=0, microsecond=0).astimezone()
-        endtime = to_get_date.replace(hour=23, minute=59, second=59, microsecond=999).astimezone()
-
-        future_events = self.get_events(calendar, starttime.astimezone(), endtime.astimezone())
-
-        matches = [ev for ev in future_events if ev.instance.vevent.dtstart.value.astimezone().date() ==
-                   to_get_date.date()]
+        matches, failed = self.query_calendars(calendars, lambda cal: self.get_events_on_day(cal, to_get_date.date()))
 
         if len(matches) == 0:
             self.speak(f"Couldnt find an appointment at {self.get_message_from_date(to_get_date, False)}.")
         elif len(matches) == 1:
-            start = (matches[0].instance.vevent.dtstart.value)
-            summary = (matches[0].instance.vevent.summary.value)
+            start = matches[0].start_datetime
+            summary = matches[0].summary
             output = f"You've got one appointment on {self.get_message_from_date(start)} and it is entitled {summary}."
             self.speak(output)
         elif len(matches) > 1:
-            appointments_string = " ".join(x.instance.vevent.summary.value + ", "
-                                           for x in matches[:-1])
+            appointments_string = " ".join(x.summary + ", " for x in matches[:-1])
             self.speak(f"I've found multiple appointments at {self.get_message_from_date(to_get_date, False)}; They are"
-                       f" entitled {appointments_string}and {matches[-1].instance.vevent.summary.value}.")
+                       f" entitled {appointments_string}and {matches[-1].summary}.")
+        self.speak_failed_calendars(failed)
 
 
 def create_skill():
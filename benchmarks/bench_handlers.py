@@ -0,0 +1,389 @@
+"""Measures the intent handlers of the skill end to end against an in-process CalDav server.
+
+Fills a stand-in of the nextcloud CalDav server with a synthetic calendar, including recurring and all-day events,
+and runs the intent handlers of the skill against it. The message bus is replaced by a fake one and the answers of the
+user are scripted, so no network, mycroft service or microphone is involved. For every handler run the latency, the
+number of HTTP requests, the bytes sent and received and the peak memory are measured. The results are written to a
+json file, so two runs can be compared to find regressions.
+
+The skill itself is loaded, so the benchmark has to run in the python environment of mycroft-core.
+
+Usage:
+    python benchmarks/bench_handlers.py --events 100 10000 100000 --repeat 3 --output bench_handlers.json
+"""
+import argparse
+from datetime import datetime, time, timedelta
+import gc
+import importlib.util
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+from time import monotonic, perf_counter, sleep
+import tracemalloc
+
+import requests
+
+from fake_caldav import FakeCalDavServer, FakeTransport
+
+SKILL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CALENDAR = "Personal"
+TOPICS = ["Team meeting", "Lunch with Alex", "Project review", "Gym", "Call with the bank", "Standup",
+          "Guitar lesson", "Birthday party", "Workshop", "Parents evening"]
+# events the write scenarios look for by name, they exist once in every calendar
+DELETE_TARGET = "Dentist appointment"
+MODIFY_TARGET = "Car service"
+# maximum time to wait for the queued writes to be sent in seconds
+WRITE_TIMEOUT = 60
+
+
+def load_skill_package():
+    """Imports the skill as package "nextcalendar" like mycroft's skill loader does.
+
+    Returns:
+        The module of the skill.
+    """
+    spec = importlib.util.spec_from_file_location("nextcalendar", os.path.join(SKILL_DIR, "__init__.py"),
+                                                  submodule_search_locations=[SKILL_DIR])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["nextcalendar"] = module
+    try:
+        spec.loader.exec_module(module)
+    except ImportError as e:
+        del sys.modules["nextcalendar"]
+        sys.exit(f"Can't load the skill ({e}). Run the benchmark in the python environment of mycroft-core.")
+    try:
+        # mycroft's skill service loads the parsers of the language, extract_datetime fails without them
+        import lingua_franca
+        lingua_franca.load_language("en-us")
+    except (ImportError, AttributeError):
+        pass
+    return module
+
+
+def fill_calendar(server: FakeCalDavServer, count: int, now: datetime, seed: int = 0):
+    """Creates a calendar with the given number of synthetic events spread over a year around now. Every 50th event
+    recurs weekly, every 7th lasts the whole day. The targets of the write scenarios are added once.
+
+    Args:
+        server: The fake server to create the calendar on.
+        count: The number of events.
+        now: An aware datetime object containing the current time.
+        seed: Optional; The seed of the random generator, so every run gets the same calendar.
+    """
+    rng = random.Random(seed)
+    calendar = server.add_calendar(CALENDAR)
+    base = now.replace(minute=0, second=0, microsecond=0)
+    for i in range(max(0, count - 2)):
+        start = base + timedelta(minutes=15 * rng.randrange(-180 * 96, 180 * 96))
+        summary = f"{rng.choice(TOPICS)} {i}"
+        if i % 50 == 0:
+            server.add_event(calendar, f"event-{i}", start, start + timedelta(hours=1), summary,
+                             rule="FREQ=WEEKLY;INTERVAL=1")
+        elif i % 7 == 0:
+            day = datetime.combine(start.date(), time.min).astimezone()
+            server.add_event(calendar, f"event-{i}", day, day + timedelta(days=1), summary, all_day=True)
+        else:
+            server.add_event(calendar, f"event-{i}", start, start + timedelta(minutes=rng.choice([30, 60, 90])),
+                             summary)
+
+    tomorrow = datetime.combine(now.date() + timedelta(days=1), time(10)).astimezone()
+    server.add_event(calendar, "dentist", tomorrow, tomorrow + timedelta(hours=1), DELETE_TARGET)
+    next_week = datetime.combine(now.date() + timedelta(days=7), time(9)).astimezone()
+    server.add_event(calendar, "car-service", next_week, next_week + timedelta(hours=2), MODIFY_TARGET)
+
+
+class FakeBus:
+    """A message bus calling the handlers of a message at once. Keeps the emitted messages, e.g. to read what the
+    skill said."""
+
+    def __init__(self):
+        self.handlers = {}
+        self.messages = []
+        self._lock = threading.Lock()
+
+
+    def on(self, msg_type: str, handler):
+        self.handlers.setdefault(msg_type, []).append(handler)
+
+
+    once = on
+
+
+    def remove(self, msg_type: str, handler):
+        if handler in self.handlers.get(msg_type, []):
+            self.handlers[msg_type].remove(handler)
+
+
+    def remove_all_listeners(self, msg_type: str):
+        self.handlers.pop(msg_type, None)
+
+
+    def emit(self, message):
+        with self._lock:
+            self.messages.append(message)
+        for handler in list(self.handlers.get(message.msg_type, [])):
+            handler(message)
+
+
+    def wait_for_response(self, message, reply_type: str = None, timeout: float = None):
+        self.emit(message)
+        return None
+
+
+    def wait_for_message(self, message_type: str, timeout: float = None):
+        return None
+
+
+    def take(self):
+        """Gets the messages emitted since the last call."""
+        with self._lock:
+            messages, self.messages = self.messages, []
+        return messages
+
+
+class ScriptedUser:
+    """Answers the questions of the skill with the scripted answers instead of listening to the user."""
+
+    def __init__(self):
+        self.answers = []
+        self.questions = []
+
+
+    def get_response(self, skill, dialog: str = '', *args, **kwargs):
+        self.questions.append(dialog)
+        if len(self.answers) == 0:
+            raise RuntimeError(f"The skill asked a question without scripted answer: {dialog}")
+        return self.answers.pop(0)
+
+
+class HandlerBench:
+    """Runs the intent handlers of a skill instance connected to the fake server and measures them."""
+
+    def __init__(self, package, server: FakeCalDavServer, data_dir: str, trace_memory: bool = False):
+        """Inits the bench without starting the skill.
+
+        Args:
+            package: The module of the skill.
+            server: The fake server the skill connects to.
+            data_dir: A string containing the path of the data directory of the skill.
+            trace_memory: Optional; Boolean to measure the peak memory with tracemalloc, which slows the handlers
+                down, so the latencies aren't comparable with runs without it.
+        """
+        self.package = package
+        self.server = server
+        self.data_dir = data_dir
+        self.trace_memory = trace_memory
+        self.transport = FakeTransport(server)
+        self.user = ScriptedUser()
+        self.bus = None
+        self.skill = None
+        self._session_init = None
+
+        # the skill asks through MycroftSkill.get_response, so the wait for the user stays traced
+        from mycroft import MycroftSkill
+        MycroftSkill.get_response = lambda skill, *args, **kwargs: self.user.get_response(skill, *args, **kwargs)
+
+
+    def start(self):
+        """Creates, binds and initializes a skill instance like mycroft's skill loader and plugs the fake server
+        into its CalDav session."""
+        self.bus = FakeBus()
+        self.skill = self.package.create_skill()
+        self.skill.skill_id = "nextcalendar.bench"
+        self.skill.settings.update({"url": "bench.invalid", "username": self.server.user, "password": "secret",
+                                    "calendar_name": CALENDAR})
+        self.skill.bind(self.bus)
+        self.skill.file_system.path = self.data_dir
+        self.skill.initialize()
+        self.skill.session.client.session.mount("https://", self.transport)
+        # the skill replaces its client when it reconnects, the new one has to talk to the fake server as well
+        self._session_init = requests.Session.__init__
+        session_init, transport = self._session_init, self.transport
+
+        def mounted(session, *args, **kwargs):
+            session_init(session, *args, **kwargs)
+            session.mount("https://", transport)
+        requests.Session.__init__ = mounted
+        self.bus.take()
+
+
+    def stop(self):
+        """Shuts the skill down, which saves its snapshot."""
+        self.skill.shutdown()
+        self.skill = None
+        if self._session_init is not None:
+            requests.Session.__init__ = self._session_init
+            self._session_init = None
+
+
+    def restart(self):
+        """Shuts the skill down and starts a new instance on the same data directory."""
+        self.stop()
+        self.start()
+
+
+    def run(self, scenario: str, intent: str, data: dict = None, answers=(), writes: bool = False):
+        """Runs an intent handler and measures it.
+
+        Args:
+            scenario: A string containing the name of the scenario in the results.
+            intent: A string containing the name of the intent, e.g. getday for handle_getday.
+            data: Optional; A dict containing the data of the intent message.
+            answers: Optional; A list of the answers to the questions the skill asks.
+            writes: Optional; Boolean to wait until the writes queued by the handler were sent to the server.
+
+        Returns:
+            A dict containing the measured values.
+        """
+        from mycroft.messagebus.message import Message
+        handler = getattr(self.skill, f"handle_{intent}")
+        message = Message(f"{intent}.intent", data=dict(data or {}, utterance=f"bench {intent}"))
+        self.user.answers = list(answers)
+        self.user.questions = []
+        self.bus.take()
+        gc.collect()
+        before = self.transport.stats()
+        if self.trace_memory:
+            tracemalloc.start()
+
+        started = perf_counter()
+        handler(message)
+        latency = perf_counter() - started
+        if writes:
+            self.wait_for_writes()
+        total = perf_counter() - started
+
+        peak = None
+        if self.trace_memory:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        after = self.transport.stats()
+        messages = self.bus.take()
+        if len(self.user.answers) > 0:
+            raise RuntimeError(f"The skill didn't ask for all scripted answers in {scenario}: {self.user.answers}")
+
+        traces = [message.data for message in messages if message.msg_type == "nextcalendar.metrics"]
+        return {
+            "scenario": scenario,
+            "intent": intent,
+            "latency_ms": round(latency * 1000, 3),
+            "with_writes_ms": round(total * 1000, 3),
+            "server_ms": round((after["server_time"] - before["server_time"]) * 1000, 3),
+            "requests": after["requests"] - before["requests"],
+            "requests_by_method": {method: count - before["methods"].get(method, 0)
+                                   for method, count in after["methods"].items()
+                                   if count != before["methods"].get(method, 0)},
+            "bytes_sent": after["bytes_sent"] - before["bytes_sent"],
+            "bytes_received": after["bytes_received"] - before["bytes_received"],
+            "peak_traced_bytes": peak,
+            "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            "stages_ms": traces[-1]["stages_ms"] if len(traces) > 0 else {},
+            "questions": self.user.questions,
+            "spoken": [message.data.get("utterance") for message in messages if message.msg_type == "speak"],
+        }
+
+
+    def wait_for_writes(self):
+        """Waits until the write queue of the skill sent all writes."""
+        deadline = monotonic() + WRITE_TIMEOUT
+        while any(len(self.skill.writes.pending(url)) > 0 for url in list(self.skill.stores)):
+            if monotonic() > deadline:
+                raise RuntimeError("The queued writes weren't sent in time")
+            sleep(0.002)
+
+
+def run_scenarios(bench: HandlerBench, repeat: int):
+    """Runs every scenario on a started bench. The reading scenarios on the warm store are repeated.
+
+    Returns:
+        A list of dicts containing the measured values of every handler run.
+    """
+    results = [dict(bench.run("nextcalendar_cold", "nextcalendar"), run=0)]
+    for i in range(repeat):
+        results.append(dict(bench.run("nextcalendar_warm", "nextcalendar"), run=i))
+    for i in range(repeat):
+        results.append(dict(bench.run("getday_warm", "getday", {"date": "tomorrow"}), run=i))
+    results.append(dict(bench.run("create", "create", {"new_name": "Bench review",
+                                                       "start_datetime": "tomorrow at 3 pm",
+                                                       "end_datetime": "tomorrow at 4 pm"}, writes=True), run=0))
+    results.append(dict(bench.run("delete", "delete", {"to_delete_name": DELETE_TARGET}, writes=True), run=0))
+    results.append(dict(bench.run("modify", "modify", {"to_edit_name": MODIFY_TARGET},
+                                  answers=["the name", "Car inspection", "no"], writes=True), run=0))
+
+    # a store older than the maximum staleness pulls the changes since its last sync
+    bench.skill.settings["max_staleness"] = 1e-6
+    results.append(dict(bench.run("nextcalendar_incremental", "nextcalendar"), run=0))
+    del bench.skill.settings["max_staleness"]
+
+    # a new instance answers from the snapshot the old one saved on shutdown
+    bench.restart()
+    results.append(dict(bench.run("nextcalendar_snapshot", "nextcalendar"), run=0))
+    return results
+
+
+def git_revision():
+    """Gets the commit of the skill or None if it isn't a git checkout."""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=SKILL_DIR, capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(f"{'events':>8} {'scenario':<26} {'latency [ms]':>13} {'requests':>9} {'sent [KB]':>10} "
+          f"{'received [KB]':>14} {'peak [MB]':>10}")
+    groups = {}
+    for result in results:
+        groups.setdefault((result["events"], result["scenario"]), []).append(result)
+    for (events, scenario), runs in groups.items():
+        peak = runs[-1]["peak_traced_bytes"]
+        print(f"{events:>8} {scenario:<26} {statistics.median(run['latency_ms'] for run in runs):>13.1f} "
+              f"{runs[-1]['requests']:>9} {runs[-1]['bytes_sent'] / 1024:>10.1f} "
+              f"{runs[-1]['bytes_received'] / 1024:>14.1f} {'-' if peak is None else f'{peak / 2 ** 20:.1f}':>10}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, nargs="+", default=[100, 10000, 100000])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--trace-memory", action="store_true",
+                        help="measure the peak memory of every run with tracemalloc, slows the handlers down")
+    parser.add_argument("--output", default="bench_handlers.json")
+    args = parser.parse_args()
+
+    package = load_skill_package()
+    results = []
+    for count in args.events:
+        server = FakeCalDavServer()
+        fill_calendar(server, count, datetime.now().astimezone())
+        with tempfile.TemporaryDirectory(prefix="nextcalendar-bench-") as data_dir:
+            bench = HandlerBench(package, server, data_dir, args.trace_memory)
+            bench.start()
+            try:
+                results.extend(dict(result, events=count) for result in run_scenarios(bench, args.repeat))
+            finally:
+                bench.stop()
+        del server, bench
+        gc.collect()
+
+    import caldav
+    with open(args.output, "w") as file:
+        json.dump({"benchmark": "handlers", "created": datetime.now().astimezone().isoformat(),
+                   "revision": git_revision(), "python": sys.version, "platform": platform.platform(),
+                   "caldav": getattr(caldav, "__version__", None), "repeat": args.repeat,
+                   "trace_memory": args.trace_memory, "results": results}, file, indent=2)
+    print_results(results)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
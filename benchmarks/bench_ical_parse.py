@@ -0,0 +1,96 @@
+"""Compares the field-selective icalendar parser against the full vobject parse.
+
+Builds a synthetic calendar-multiget response and measures the time needed to create the event records from it,
+once by parsing every event into a vobject tree and once with the field-selective parser of the skill.
+
+Usage:
+    python benchmarks/bench_ical_parse.py --events 10000 --repeat 3
+"""
+import argparse
+from datetime import datetime, timedelta
+import importlib
+import os
+import sys
+import time
+import types
+
+from lxml import etree
+import vobject
+
+SKILL_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_skill_module(name: str):
+    """Imports a module of the skill without running the skill's __init__.py, which needs mycroft."""
+    if "nextcalendar" not in sys.modules:
+        package = types.ModuleType("nextcalendar")
+        package.__path__ = [SKILL_DIR]
+        sys.modules["nextcalendar"] = package
+    return importlib.import_module(f"nextcalendar.{name}")
+
+
+ical = import_skill_module("ical")
+records = import_skill_module("records")
+store = import_skill_module("store")
+
+
+def make_event(i: int):
+    """Creates the payload of a synthetic event. Every third event is all-day, every event has an alarm."""
+    start = datetime(2015, 1, 1, 8) + timedelta(hours=7 * i)
+    if i % 3 == 0:
+        dates = f"DTSTART;VALUE=DATE:{start:%Y%m%d}\r\nDTEND;VALUE=DATE:{start + timedelta(days=1):%Y%m%d}\r\n"
+    else:
+        dates = (f"DTSTART;TZID=Europe/Berlin:{start:%Y%m%dT%H%M%S}\r\n"
+                 f"DTEND;TZID=Europe/Berlin:{start + timedelta(hours=1):%Y%m%dT%H%M%S}\r\n")
+    return ("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//bench//EN\r\n"
+            "BEGIN:VTIMEZONE\r\nTZID:Europe/Berlin\r\nBEGIN:STANDARD\r\nDTSTART:19701025T030000\r\n"
+            "TZOFFSETFROM:+0200\r\nTZOFFSETTO:+0100\r\nEND:STANDARD\r\nEND:VTIMEZONE\r\n"
+            f"BEGIN:VEVENT\r\nUID:event-{i}@bench\r\nDTSTAMP:20150101T000000Z\r\n{dates}"
+            f"SUMMARY:Appointment number {i} with a rather long name to get fol\r\n ded\r\n"
+            "DESCRIPTION:Some description which the intent handlers never read\r\n"
+            "BEGIN:VALARM\r\nACTION:DISPLAY\r\nTRIGGER:-PT15M\r\nDESCRIPTION:Reminder\r\nEND:VALARM\r\n"
+            "END:VEVENT\r\nEND:VCALENDAR\r\n")
+
+
+def make_multistatus(count: int):
+    """Creates a calendar-multiget response body containing the given number of events."""
+    responses = "".join(
+        f"<d:response><d:href>/calendars/bench/event-{i}.ics</d:href><d:propstat><d:prop>"
+        f"<d:getetag>\"{i}\"</d:getetag><c:calendar-data>{make_event(i)}</c:calendar-data>"
+        f"</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat></d:response>" for i in range(count))
+    return (f'<?xml version="1.0" encoding="utf-8"?><d:multistatus xmlns:d="DAV:" '
+            f'xmlns:c="urn:ietf:params:xml:ns:caldav">{responses}</d:multistatus>').encode()
+
+
+def full_parse(data: str, href: str, etag: str):
+    return records.EventRecord.from_vevent(vobject.readOne(data).vevent, href, etag)
+
+
+def run(parse, body: bytes, repeat: int):
+    """Parses the response body with the given function and returns the best time of all runs."""
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        for href, found, props in store.parse_multistatus(etree.fromstring(body)):
+            parse(props[store.CALDAV + "calendar-data"], href, props[store.DAV + "getetag"])
+        elapsed = time.perf_counter() - begin
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--events", type=int, nargs="+", default=[100, 1000, 10000])
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    print(f"{'events':>8} {'vobject [s]':>12} {'selective [s]':>14} {'speedup':>8}")
+    for count in args.events:
+        body = make_multistatus(count)
+        full = run(full_parse, body, args.repeat)
+        selective = run(ical.parse_record, body, args.repeat)
+        print(f"{count:>8} {full:>12.3f} {selective:>14.3f} {full / selective:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,494 @@
+"""An in-process stand-in for the CalDav server of a nextcloud, used by the handler benchmark.
+
+The server keeps its calendars in memory and answers the requests the skill sends: the discovery PROPFINDs, the
+sync-collection, calendar-multiget and calendar-query reports (with text-match, time-range and expand) and the
+conditional GET, PUT and DELETE requests of single events. It is plugged into the requests session of the DAVClient
+as transport adapter, so no socket is opened and the requests and transferred bytes can be counted exactly.
+"""
+from datetime import datetime, time, timezone
+from http import HTTPStatus
+import itertools
+import threading
+from time import perf_counter
+from urllib.parse import unquote, urlsplit
+from xml.sax.saxutils import escape
+
+from dateutil.rrule import rrulestr
+from lxml import etree
+import requests
+from requests.adapters import BaseAdapter
+from requests.structures import CaseInsensitiveDict
+import vobject
+
+DAV = "{DAV:}"
+CALDAV = "{urn:ietf:params:xml:ns:caldav}"
+CALSERVER = "{http://calendarserver.org/ns/}"
+PREFIXES = {"DAV:": "d", "urn:ietf:params:xml:ns:caldav": "c", "http://calendarserver.org/ns/": "cs"}
+
+ROOT = "/nc/remote.php/dav/"
+SYNC_TOKEN = "http://bench.invalid/sync/"
+XML_HEADERS = {"Content-Type": "application/xml; charset=utf-8"}
+# properties answered for a PROPFIND without body
+ALLPROP = [DAV + "displayname", DAV + "resourcetype", DAV + "getetag", CALSERVER + "getctag"]
+
+
+def format_utc(value: datetime):
+    return f"{value.astimezone(timezone.utc):%Y%m%dT%H%M%SZ}"
+
+
+def parse_utc(value: str):
+    return datetime.strptime(value, "%Y%m%dT%H%M%SZ").replace(tzinfo=timezone.utc)
+
+
+def prefixed(tag: str):
+    """Converts a tag in clark notation to a prefixed xml element name, declaring unknown namespaces in place."""
+    namespace, _, name = tag[1:].partition("}")
+    prefix = PREFIXES.get(namespace)
+    if prefix is None:
+        return f'x:{name} xmlns:x="{escape(namespace)}"', f"x:{name}"
+    return f"{prefix}:{name}", f"{prefix}:{name}"
+
+
+def make_event_data(uid: str, start: datetime, end: datetime, summary: str, all_day: bool = False, rule: str = None):
+    """Creates the icalendar payload of an event the way nextcloud stores it, with a description and an alarm.
+
+    Args:
+        uid: A string containing the uid of the event.
+        start: An aware datetime object containing the start.
+        end: An aware datetime object containing the end.
+        summary: A string containing the name of the event.
+        all_day: Optional; Boolean telling whether the event lasts whole days.
+        rule: Optional; A string containing the RRULE value of a recurring event.
+    """
+    if all_day:
+        dates = f"DTSTART;VALUE=DATE:{start:%Y%m%d}\r\nDTEND;VALUE=DATE:{end:%Y%m%d}\r\n"
+    else:
+        dates = f"DTSTART:{format_utc(start)}\r\nDTEND:{format_utc(end)}\r\n"
+    recurrence = f"RRULE:{rule}\r\n" if rule is not None else ""
+    return ("BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Nextcloud calendar bench//EN\r\n"
+            f"BEGIN:VEVENT\r\nUID:{uid}\r\nDTSTAMP:20200101T000000Z\r\n{dates}{recurrence}SUMMARY:{summary}\r\n"
+            "DESCRIPTION:Synthetic event of the handler benchmark\r\n"
+            "BEGIN:VALARM\r\nACTION:DISPLAY\r\nTRIGGER:-PT15M\r\nDESCRIPTION:Reminder\r\nEND:VALARM\r\n"
+            "END:VEVENT\r\nEND:VCALENDAR\r\n")
+
+
+class FakeEvent:
+    """An event stored by the fake server with the values its filters need."""
+
+    __slots__ = ("href", "etag", "data", "start", "end", "summary", "rule")
+
+    def __init__(self, href: str, etag: str, data: str, start: datetime, end: datetime, summary: str,
+                 rule: str = None):
+        self.href = href
+        self.etag = etag
+        self.data = data
+        self.start = start
+        self.end = end
+        self.summary = summary
+        self.rule = rule
+
+
+    def instances(self, start: datetime, end: datetime):
+        """Gets the starts of the instances overlapping the given time span."""
+        if self.rule is None:
+            return [self.start] if self.start < end and (self.end > start or self.start >= start) else []
+        duration = self.end - self.start
+        return rrulestr(self.rule, dtstart=self.start).between(start - duration, end, inc=False)
+
+
+class FakeCalendar:
+    """A calendar collection of the fake server. Every change appends the href to the change log, whose length is
+    the sync-token."""
+
+    def __init__(self, name: str, path: str):
+        self.name = name
+        self.path = path
+        self.events = {}
+        self.changes = []
+
+
+    @property
+    def sync_token(self):
+        return f"{SYNC_TOKEN}{len(self.changes)}"
+
+
+    def store(self, event: FakeEvent):
+        self.events[event.href] = event
+        self.changes.append(event.href)
+
+
+    def remove(self, href: str):
+        del self.events[href]
+        self.changes.append(href)
+
+
+class FakeCalDavServer:
+    """The CalDav server of a nextcloud account held in memory."""
+
+    def __init__(self, user: str = "bench"):
+        """Inits a server without calendars.
+
+        Args:
+            user: Optional; A string containing the name of the nextcloud user.
+        """
+        self.user = user
+        self.principal = f"{ROOT}principals/users/{user}/"
+        self.home = f"{ROOT}calendars/{user}/"
+        self.calendars = {}
+        self._etags = itertools.count(1)
+        self._lock = threading.Lock()
+
+
+    def add_calendar(self, name: str):
+        """Creates an empty calendar.
+
+        Args:
+            name: A string containing the display name of the calendar.
+
+        Returns:
+            The created calendar.
+        """
+        path = f"{self.home}{name.lower().replace(' ', '-')}/"
+        calendar = self.calendars[path] = FakeCalendar(name, path)
+        return calendar
+
+
+    def add_event(self, calendar: FakeCalendar, uid: str, start: datetime, end: datetime, summary: str,
+                  all_day: bool = False, rule: str = None):
+        """Stores a new event in a calendar.
+
+        Args:
+            calendar: The calendar to store the event in.
+            uid: A string containing the uid of the event, which is also used for its href.
+            start: An aware datetime object containing the start.
+            end: An aware datetime object containing the end.
+            summary: A string containing the name of the event.
+            all_day: Optional; Boolean telling whether the event lasts whole days.
+            rule: Optional; A string containing the RRULE value of a recurring event.
+
+        Returns:
+            A string containing the href of the event.
+        """
+        href = f"{calendar.path}{uid}.ics"
+        data = make_event_data(uid, start, end, summary, all_day, rule)
+        calendar.store(FakeEvent(href, self._etag(), data, start, end, summary, rule))
+        return href
+
+
+    def handle(self, method: str, url: str, headers, body: bytes):
+        """Answers a request.
+
+        Args:
+            method: A string containing the HTTP method.
+            url: A string containing the requested url.
+            headers: A dict containing the request headers.
+            body: A bytes object containing the request body.
+
+        Returns:
+            A tuple containing the status, a dict with the response headers and the response body as bytes.
+        """
+        path = unquote(urlsplit(url).path)
+        with self._lock:
+            if method == "PROPFIND":
+                return self._propfind(path, headers.get("Depth", "0"), body)
+            if method == "REPORT":
+                return self._report(path, body)
+            if method == "GET":
+                return self._get(path)
+            if method == "PUT":
+                return self._put(path, headers, body)
+            if method == "DELETE":
+                return self._delete(path, headers)
+        return 405, {}, b""
+
+
+    def _etag(self):
+        return f'"{next(self._etags)}"'
+
+
+    def _resource(self, path: str):
+        """Finds the resource at a path.
+
+        Returns:
+            A tuple containing the kind of the resource, its canonical path and the resource object or None if there
+            is no resource at the path.
+        """
+        collection = path if path.endswith("/") else path + "/"
+        if collection in (ROOT, self.principal, self.home):
+            return {ROOT: "root", self.principal: "principal", self.home: "home"}[collection], collection, None
+        if collection in self.calendars:
+            return "calendar", collection, self.calendars[collection]
+        calendar = self.calendars.get(path.rsplit("/", 1)[0] + "/")
+        if calendar is not None and path in calendar.events:
+            return "event", path, calendar.events[path]
+        return None
+
+
+    def _children(self, kind: str, resource):
+        if kind == "home":
+            return [("calendar", calendar.path, calendar) for calendar in self.calendars.values()]
+        if kind == "calendar":
+            return [("event", event.href, event) for event in resource.events.values()]
+        return []
+
+
+    def _property(self, kind: str, resource, tag: str):
+        """Gets the xml content of a property of a resource or None if the resource doesn't have it."""
+        if tag == DAV + "current-user-principal":
+            return f"<d:href>{self.principal}</d:href>"
+        if tag == CALDAV + "calendar-home-set" and kind in ("root", "principal"):
+            return f"<d:href>{self.home}</d:href>"
+        if tag == DAV + "resourcetype":
+            return {"calendar": "<d:collection/><c:calendar/>", "event": ""}.get(kind, "<d:collection/>")
+        if kind == "calendar":
+            if tag == DAV + "displayname":
+                return escape(resource.name)
+            if tag == CALSERVER + "getctag" or tag == DAV + "sync-token":
+                return resource.sync_token
+        if kind == "event" and tag == DAV + "getetag":
+            return escape(resource.etag)
+        return None
+
+
+    def _propfind(self, path: str, depth: str, body: bytes):
+        found = self._resource(path)
+        if found is None:
+            return 404, {}, b""
+        kind, canonical, resource = found
+        tags = ALLPROP
+        if len(body.strip()) > 0:
+            prop = etree.fromstring(body).find(DAV + "prop")
+            if prop is not None:
+                tags = [element.tag for element in prop]
+
+        # the resource itself is answered with the path as requested, like nextcloud does
+        resources = [(kind, path, resource)]
+        if depth != "0":
+            resources.extend(self._children(kind, resource))
+        responses = []
+        for kind, href, resource in resources:
+            values = [(tag, self._property(kind, resource, tag)) for tag in tags]
+            responses.append(self._response(href, {tag: value for tag, value in values if value is not None},
+                                            [tag for tag, value in values if value is None]))
+        return self._multistatus(responses)
+
+
+    def _report(self, path: str, body: bytes):
+        found = self._resource(path)
+        if found is None or found[0] != "calendar":
+            return 404, {}, b""
+        calendar = found[2]
+        root = etree.fromstring(body)
+        if root.tag == DAV + "sync-collection":
+            return self._sync_collection(calendar, root.findtext(DAV + "sync-token") or "")
+        if root.tag == CALDAV + "calendar-multiget":
+            hrefs = [unquote(href.text) for href in root.iter(DAV + "href")]
+            return self._multistatus([self._event_response(calendar.events.get(href), href,
+                                                           self._expanded_data(calendar.events.get(href), root))
+                                      for href in hrefs])
+        if root.tag == CALDAV + "calendar-query":
+            return self._calendar_query(calendar, root)
+        return 501, {}, b""
+
+
+    def _sync_collection(self, calendar: FakeCalendar, token: str):
+        if token == "":
+            changed = list(calendar.events)
+        elif not token.startswith(SYNC_TOKEN) or not token[len(SYNC_TOKEN):].isdigit() or \
+                int(token[len(SYNC_TOKEN):]) > len(calendar.changes):
+            # nextcloud answers an unknown sync-token with 403 valid-sync-token
+            return 403, XML_HEADERS, b'<?xml version="1.0" encoding="utf-8"?><d:error xmlns:d="DAV:">' \
+                                     b'<d:valid-sync-token/></d:error>'
+        else:
+            changed = list(dict.fromkeys(calendar.changes[int(token[len(SYNC_TOKEN):]):]))
+        responses = []
+        for href in changed:
+            event = calendar.events.get(href)
+            if event is None:
+                responses.append(f"<d:response><d:href>{escape(href)}</d:href>"
+                                 f"<d:status>HTTP/1.1 404 Not Found</d:status></d:response>")
+            else:
+                responses.append(self._response(href, {DAV + "getetag": escape(event.etag)}))
+        return self._multistatus(responses, calendar.sync_token)
+
+
+    def _calendar_query(self, calendar: FakeCalendar, root):
+        text = root.findtext(f".//{CALDAV}text-match")
+        time_range = root.find(f".//{CALDAV}comp-filter/{CALDAV}time-range")
+        start = end = None
+        if time_range is not None:
+            start = parse_utc(time_range.get("start"))
+            end = parse_utc(time_range.get("end"))
+
+        responses = []
+        for event in calendar.events.values():
+            if text is not None and text.lower() not in event.summary.lower():
+                continue
+            if start is not None and len(event.instances(start, end)) == 0:
+                continue
+            responses.append(self._event_response(event, event.href, self._expanded_data(event, root)))
+        return self._multistatus(responses)
+
+
+    def _expanded_data(self, event: FakeEvent, root):
+        """Gets the payload of an event for a report, expanded if the report asks for it. Returns None for the stored
+        payload."""
+        expand = root.find(f".//{CALDAV}calendar-data/{CALDAV}expand")
+        if event is None or expand is None or event.rule is None:
+            return None
+        return self._expand(event, parse_utc(expand.get("start")), parse_utc(expand.get("end")))
+
+
+    @staticmethod
+    def _expand(event: FakeEvent, start: datetime, end: datetime):
+        """Replaces the recurrence of an event by its instances in the time span, as a server does for expand."""
+        uid = event.href.rsplit("/", 1)[1][:-len(".ics")]
+        duration = event.end - event.start
+        instances = "".join(f"BEGIN:VEVENT\r\nUID:{uid}\r\nRECURRENCE-ID:{format_utc(instance)}\r\n"
+                            f"DTSTART:{format_utc(instance)}\r\nDTEND:{format_utc(instance + duration)}\r\n"
+                            f"SUMMARY:{event.summary}\r\nEND:VEVENT\r\n" for instance in event.instances(start, end))
+        return (f"BEGIN:VCALENDAR\r\nVERSION:2.0\r\nPRODID:-//Nextcloud calendar bench//EN\r\n{instances}"
+                "END:VCALENDAR\r\n")
+
+
+    def _get(self, path: str):
+        found = self._resource(path)
+        if found is None or found[0] != "event":
+            return 404, {}, b""
+        event = found[2]
+        return 200, {"Content-Type": "text/calendar; charset=utf-8", "ETag": event.etag}, event.data.encode("utf-8")
+
+
+    def _put(self, path: str, headers, body: bytes):
+        calendar = self.calendars.get(path.rsplit("/", 1)[0] + "/")
+        if calendar is None:
+            return 409, {}, b""
+        existing = calendar.events.get(path)
+        if headers.get("If-None-Match") == "*" and existing is not None:
+            return 412, {}, b""
+        if headers.get("If-Match") is not None and (existing is None or existing.etag != headers["If-Match"]):
+            return 412, {}, b""
+
+        data = body.decode("utf-8")
+        vevent = vobject.readOne(data).vevent
+        start = self._aware(vevent.dtstart.value)
+        end = self._aware(vevent.dtend.value) if hasattr(vevent, "dtend") else start
+        rule = vevent.rrule.value if hasattr(vevent, "rrule") else None
+        summary = vevent.summary.value if hasattr(vevent, "summary") else ""
+        event = FakeEvent(path, self._etag(), data, start, end, summary, rule)
+        calendar.store(event)
+        return 201 if existing is None else 204, {"ETag": event.etag}, b""
+
+
+    def _delete(self, path: str, headers):
+        found = self._resource(path)
+        if found is None or found[0] != "event":
+            return 404, {}, b""
+        if headers.get("If-Match") is not None and found[2].etag != headers["If-Match"]:
+            return 412, {}, b""
+        self.calendars[path.rsplit("/", 1)[0] + "/"].remove(path)
+        return 204, {}, b""
+
+
+    @staticmethod
+    def _aware(value):
+        """Converts the date or floating time of a stored event to an aware datetime in the local timezone."""
+        if not isinstance(value, datetime):
+            value = datetime.combine(value, time.min)
+        return value if value.tzinfo is not None else value.astimezone()
+
+
+    def _event_response(self, event: FakeEvent, href: str, data: str = None):
+        if event is None:
+            return (f"<d:response><d:href>{escape(href)}</d:href>"
+                    f"<d:status>HTTP/1.1 404 Not Found</d:status></d:response>")
+        return self._response(href, {DAV + "getetag": escape(event.etag),
+                                     CALDAV + "calendar-data": escape(data if data is not None else event.data)})
+
+
+    @staticmethod
+    def _response(href: str, found: dict, missing=()):
+        """Creates a response element with a propstat for the found and one for the missing properties."""
+        propstats = []
+        if len(found) > 0:
+            props = "".join(f"<{opening}>{value}</{closing}>"
+                            for (opening, closing), value in ((prefixed(tag), value) for tag, value in found.items()))
+            propstats.append(f"<d:propstat><d:prop>{props}</d:prop><d:status>HTTP/1.1 200 OK</d:status></d:propstat>")
+        if len(missing) > 0:
+            props = "".join(f"<{prefixed(tag)[0]}/>" for tag in missing)
+            propstats.append(f"<d:propstat><d:prop>{props}</d:prop>"
+                             f"<d:status>HTTP/1.1 404 Not Found</d:status></d:propstat>")
+        return f"<d:response><d:href>{escape(href)}</d:href>{''.join(propstats)}</d:response>"
+
+
+    @staticmethod
+    def _multistatus(responses, sync_token: str = None):
+        token = f"<d:sync-token>{sync_token}</d:sync-token>" if sync_token is not None else ""
+        body = (f'<?xml version="1.0" encoding="utf-8"?><d:multistatus xmlns:d="DAV:" '
+                f'xmlns:c="urn:ietf:params:xml:ns:caldav" xmlns:cs="http://calendarserver.org/ns/">'
+                f'{"".join(responses)}{token}</d:multistatus>')
+        return 207, XML_HEADERS, body.encode("utf-8")
+
+
+class FakeTransport(BaseAdapter):
+    """A requests transport adapter answering the requests with the fake server instead of opening a connection.
+    Counts the requests, the bytes sent and received including the headers and the time spent in the server."""
+
+    def __init__(self, server: FakeCalDavServer):
+        super().__init__()
+        self.server = server
+        self._lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        """Sets all counters to zero."""
+        with self._lock:
+            self.requests = 0
+            self.methods = {}
+            self.bytes_sent = 0
+            self.bytes_received = 0
+            self.server_time = 0.0
+
+
+    def stats(self):
+        """Gets the current values of the counters as dict."""
+        with self._lock:
+            return {"requests": self.requests, "methods": dict(self.methods), "bytes_sent": self.bytes_sent,
+                    "bytes_received": self.bytes_received, "server_time": self.server_time}
+
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        body = request.body or b""
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        started = perf_counter()
+        status, headers, content = self.server.handle(request.method, request.url, request.headers, body)
+        elapsed = perf_counter() - started
+
+        response = requests.Response()
+        response.status_code = status
+        response.reason = HTTPStatus(status).phrase
+        response.headers = CaseInsensitiveDict(headers)
+        response.headers["Content-Length"] = str(len(content))
+        response._content = content
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        response.connection = self
+
+        sent = len(f"{request.method} {request.path_url} HTTP/1.1\r\n") + len(body) + 2 + \
+            sum(len(name) + len(value) + 4 for name, value in request.headers.items())
+        received = len(f"HTTP/1.1 {status} {response.reason}\r\n") + len(content) + 2 + \
+            sum(len(name) + len(value) + 4 for name, value in response.headers.items())
+        with self._lock:
+            self.requests += 1
+            self.methods[request.method] = self.methods.get(request.method, 0) + 1
+            self.bytes_sent += sent
+            self.bytes_received += received
+            self.server_time += elapsed
+        return response
+
+
+    def close(self):
+        pass
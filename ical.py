@@ -0,0 +1,259 @@
+from datetime import datetime, date, timedelta
+from functools import lru_cache
+import re
+
+from dateutil import tz
+
+from .records import EventRecord, to_timestamp
+
+# the only properties of an event read by the intent handlers
+WANTED = {"DTSTART", "DTEND", "DURATION", "SUMMARY", "UID", "RECURRENCE-ID"}
+# properties kept as raw content lines to expand the instances of recurring events
+RECURRENCE = {"DTSTART", "RRULE", "RDATE", "EXDATE"}
+
+DURATION = re.compile(r"([+-])?P(?:(\d+)W)?(?:(\d+)D)?(?:T(?:(\d+)H)?(?:(\d+)M)?(?:(\d+)S)?)?$")
+TEXT_ESCAPES = re.compile(r"\\([\\;,nN])")
+
+
+class UnsupportedEvent(ValueError):
+    """Raised if an event uses features the field-selective parser can't handle, e.g. a timezone which is only
+    defined in the VTIMEZONE component of the payload."""
+
+
+def unfolded_lines(data: str):
+    """Splits an icalendar payload into its logical lines by joining the folded continuation lines.
+
+    Args:
+        data: A string containing the icalendar payload.
+
+    Yields:
+        The unfolded content lines.
+    """
+    line = None
+    for raw in data.splitlines():
+        if raw[:1] in (" ", "\t"):
+            if line is not None:
+                line += raw[1:]
+            continue
+        if line is not None:
+            yield line
+        line = raw
+    if line is not None:
+        yield line
+
+
+def split_property(line: str):
+    """Splits a content line into its name, parameters and value.
+
+    Args:
+        line: A string containing an unfolded content line.
+
+    Returns:
+        A tuple containing the uppercased name, a dict of the uppercased parameter names and their values and the
+        value string.
+    """
+    quoted = False
+    for i, char in enumerate(line):
+        if char == '"':
+            quoted = not quoted
+        elif char == ":" and not quoted:
+            break
+    else:
+        return line.upper(), {}, ""
+    name, *params = line[:i].split(";")
+    parameters = {}
+    for param in params:
+        key, _, value = param.partition("=")
+        parameters[key.upper()] = value.strip('"')
+    return name.upper(), parameters, line[i + 1:]
+
+
+@lru_cache(maxsize=64)
+def get_timezone(tzid: str):
+    """Looks up a timezone by its TZID. The lookups are cached, since calendars use only few timezones.
+
+    Args:
+        tzid: A string containing the TZID parameter.
+
+    Returns:
+        A tzinfo object or None if the timezone is unknown.
+    """
+    return tz.gettz(tzid)
+
+
+def parse_date_value(value: str, parameters: dict):
+    """Parses the value of a DATE or DATE-TIME property.
+
+    Args:
+        value: A string containing the property value.
+        parameters: A dict containing the parameters of the property.
+
+    Returns:
+        A date object for VALUE=DATE, a datetime object otherwise. Datetimes without TZID and without utc suffix are
+        returned naive as floating time.
+    """
+    value = value.strip()
+    if parameters.get("VALUE", "").upper() == "DATE" or len(value) == 8:
+        return date(int(value[0:4]), int(value[4:6]), int(value[6:8]))
+
+    result = datetime(int(value[0:4]), int(value[4:6]), int(value[6:8]),
+                      int(value[9:11]), int(value[11:13]), int(value[13:15]))
+    if value.endswith("Z"):
+        return result.replace(tzinfo=tz.UTC)
+    tzid = parameters.get("TZID")
+    if tzid is not None:
+        timezone = get_timezone(tzid)
+        if timezone is None:
+            raise UnsupportedEvent(f"Unknown timezone {tzid}")
+        return result.replace(tzinfo=timezone)
+    return result
+
+
+def parse_duration(value: str):
+    """Parses the value of a DURATION property.
+
+    Args:
+        value: A string containing the property value, e.g. PT1H30M.
+
+    Returns:
+        A timedelta object.
+    """
+    match = DURATION.match(value.strip())
+    if match is None:
+        raise UnsupportedEvent(f"Invalid duration {value}")
+    sign, weeks, days, hours, minutes, seconds = match.groups()
+    duration = timedelta(weeks=int(weeks or 0), days=int(days or 0), hours=int(hours or 0),
+                         minutes=int(minutes or 0), seconds=int(seconds or 0))
+    return -duration if sign == "-" else duration
+
+
+def unescape_text(value: str):
+    """Resolves the backslash escapes of a TEXT value."""
+    return TEXT_ESCAPES.sub(lambda match: "\n" if match.group(1) in "nN" else match.group(1), value)
+
+
+def read_events(data: str):
+    """Scans an icalendar payload for the properties of its events. Only the properties in WANTED are kept, all other
+    lines and nested components (e.g. VALARM) are skipped without being parsed. The content lines of the properties
+    in RECURRENCE are kept unparsed in the list stored under the key "LINES".
+
+    Args:
+        data: A string containing the icalendar payload.
+
+    Returns:
+        A list of dicts containing the name, parameters and value of the found properties for every event, i.e. the
+        master event and the overridden instances of a recurring event.
+    """
+    events = []
+    properties = None
+    depth = 0
+    for line in unfolded_lines(data):
+        if line[:6].upper() == "BEGIN:":
+            if properties is not None:
+                depth += 1
+            elif line[6:].strip().upper() == "VEVENT":
+                properties = {"LINES": []}
+            continue
+        if properties is None:
+            continue
+        if line[:4].upper() == "END:":
+            if depth == 0:
+                events.append(properties)
+                properties = None
+            else:
+                depth -= 1
+            continue
+        if depth > 0:
+            continue
+        name, parameters, value = split_property(line)
+        if name in WANTED:
+            properties[name] = (parameters, value)
+        if name in RECURRENCE:
+            properties["LINES"].append(line)
+    return events
+
+
+def read_times(properties: dict):
+    """Reads start and end of an event from its properties.
+
+    Args:
+        properties: A dict containing the properties of the event as returned by read_events.
+
+    Returns:
+        A tuple containing the start and the end as date or datetime objects.
+    """
+    start = parse_date_value(properties["DTSTART"][1], properties["DTSTART"][0])
+    if "DTEND" in properties:
+        end = parse_date_value(properties["DTEND"][1], properties["DTEND"][0])
+    elif "DURATION" in properties:
+        end = start + parse_duration(properties["DURATION"][1])
+    else:
+        end = start + timedelta(days=1) if not isinstance(start, datetime) else start
+    return start, end
+
+
+def read_summary(properties: dict):
+    """Reads the unescaped name of an event from its properties or None if it has no name."""
+    return unescape_text(properties["SUMMARY"][1]) if "SUMMARY" in properties else None
+
+
+def parse_record(data: str, href: str, etag: str = None):
+    """Creates an event record from an icalendar payload without building the complete vobject tree.
+
+    Args:
+        data: A string containing the icalendar payload.
+        href: A string containing the href of the event on the server.
+        etag: Optional; A string containing the etag of the event on the server.
+
+    Returns:
+        The created record or None if the payload contains no event.
+
+    Raises:
+        UnsupportedEvent: The event can't be read without a full parse.
+    """
+    events = read_events(data)
+    properties = next((event for event in events if "RECURRENCE-ID" not in event), None)
+    if properties is None or "DTSTART" not in properties:
+        return None
+    start, end = read_times(properties)
+    all_day = not isinstance(start, datetime)
+    summary = read_summary(properties) or ""
+    uid = properties["UID"][1] if "UID" in properties else href
+
+    recurrence = None
+    overrides = []
+    lines = properties["LINES"]
+    if any(split_property(line)[0] in ("RRULE", "RDATE") for line in lines):
+        for override in events:
+            if "RECURRENCE-ID" not in override or "DTSTART" not in override:
+                continue
+            # the overridden instance replaces the one the rule generates at its recurrence-id
+            parameters, value = override["RECURRENCE-ID"]
+            lines = lines + [";".join(["EXDATE"] + [f"{key}={param}" for key, param in parameters.items()
+                                                    if key in ("TZID", "VALUE")]) + ":" + value]
+            override_start, override_end = read_times(override)
+            overrides.append((to_timestamp(override_start), to_timestamp(override_end), read_summary(override)))
+        recurrence = "\n".join(lines)
+    return EventRecord(to_timestamp(start), to_timestamp(end), all_day, summary, uid, href, etag, recurrence,
+                       tuple(overrides))
+
+
+def parse_occurrences(data: str):
+    """Reads the instances of the events in an icalendar payload, which was expanded by the server.
+
+    Args:
+        data: A string containing the expanded icalendar payload.
+
+    Returns:
+        A list of tuples containing the start and end as utc timestamps and the name of every instance or None if the
+        payload still contains recurrence rules, i.e. the server didn't expand it.
+    """
+    occurrences = []
+    for properties in read_events(data):
+        if any(split_property(line)[0] in ("RRULE", "RDATE") for line in properties["LINES"]):
+            return None
+        if "DTSTART" not in properties:
+            continue
+        start, end = read_times(properties)
+        occurrences.append((to_timestamp(start), to_timestamp(end), read_summary(properties) or ""))
+    return occurrences
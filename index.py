@@ -0,0 +1,105 @@
+from bisect import bisect_left, bisect_right
+
+# minimal number of events for which adding them at once by sorting is faster than inserting each of them, the batch
+# also has to be big compared to the index
+BULK_THRESHOLD = 64
+
+
+class EventIndex:
+    """A sorted index of events by their start time.
+
+    The start times are kept as utc timestamps in one sorted list with the hrefs of the events in a parallel list, so
+    range queries are a binary search followed by a scan over the results only. The index gets updated in place when
+    events are added, changed or removed.
+    """
+
+    def __init__(self):
+        """Inits an empty index"""
+        self._starts = []
+        self._hrefs = []
+        self._keys = {}
+
+
+    def __len__(self):
+        return len(self._hrefs)
+
+
+    def add(self, href: str, start: float):
+        """Adds an event to the index or moves it to its new start time, if it is already contained.
+
+        Args:
+            href: A string containing the href of the event.
+            start: A float representing the start of the event as utc timestamp.
+        """
+        if href in self._keys:
+            self.remove(href)
+        i = bisect_right(self._starts, start)
+        self._starts.insert(i, start)
+        self._hrefs.insert(i, href)
+        self._keys[href] = start
+
+
+    def add_many(self, items):
+        """Adds many events at once, e.g. when a calendar gets loaded. Big batches are merged by sorting once instead
+        of inserting every event on its own.
+
+        Args:
+            items: A list of tuples containing the href and the start of the events as utc timestamp.
+        """
+        if len(items) < max(BULK_THRESHOLD, len(self._hrefs) // 16):
+            for href, start in items:
+                self.add(href, start)
+            return
+        items = list(dict(items).items())
+        for href, _ in items:
+            self.remove(href)
+        self._keys.update(items)
+        merged = sorted(zip(self._starts + [start for _, start in items], self._hrefs + [href for href, _ in items]),
+                        key=lambda item: item[0])
+        self._starts = [start for start, _ in merged]
+        self._hrefs = [href for _, href in merged]
+
+
+    def remove(self, href: str):
+        """Removes an event from the index. Does nothing if the event isn't contained.
+
+        Args:
+            href: A string containing the href of the event.
+        """
+        start = self._keys.pop(href, None)
+        if start is None:
+            return
+        i = bisect_left(self._starts, start)
+        while self._hrefs[i] != href:
+            i += 1
+        del self._starts[i]
+        del self._hrefs[i]
+
+
+    def between(self, start: float = None, end: float = None):
+        """Finds the events starting between start and end.
+
+        Args:
+            start: Optional; A float representing the minimal start as utc timestamp.
+            end: Optional; A float representing the maximum start as utc timestamp.
+
+        Returns:
+            A list of the hrefs of the found events sorted by their start.
+        """
+        lo = 0 if start is None else bisect_left(self._starts, start)
+        hi = len(self._starts) if end is None else bisect_right(self._starts, end)
+        return self._hrefs[lo:hi]
+
+
+    def after(self, start: float, count: int = 1):
+        """Finds the next events starting at or after the given time.
+
+        Args:
+            start: A float representing the minimal start as utc timestamp.
+            count: Optional; The maximum number of events to return.
+
+        Returns:
+            A list of the hrefs of the found events sorted by their start.
+        """
+        lo = bisect_left(self._starts, start)
+        return self._hrefs[lo:lo + count]
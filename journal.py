@@ -0,0 +1,195 @@
+import json
+import sqlite3
+import threading
+import time
+
+# results of sending a write to the server
+DONE = "done"
+FAILED = "failed"
+RETRY = "retry"
+
+# delays between two attempts of a failing write in seconds, doubled on every failure
+RETRY_DELAY = 5
+MAX_RETRY_DELAY = 600
+# number of attempts after which a failing write is given up, about a day with the delays above
+MAX_ATTEMPTS = 150
+
+
+class Write:
+    """A calendar write waiting in the queue."""
+
+    __slots__ = ("id", "calendar", "kind", "href", "payload", "attempts")
+
+    def __init__(self, id: int, calendar: str, kind: str, href: str, payload: dict, attempts: int = 0):
+        """Inits the write.
+
+        Args:
+            id: The position of the write in the journal.
+            calendar: A string containing the url of the calendar.
+            kind: A string containing the kind of the write (create, modify or delete).
+            href: A string containing the href of the written event.
+            payload: A dict containing the data needed to send the write.
+            attempts: Optional; The number of failed attempts to send the write.
+        """
+        self.id = id
+        self.calendar = calendar
+        self.kind = kind
+        self.href = href
+        self.payload = payload
+        self.attempts = attempts
+
+
+    @property
+    def last_attempt(self):
+        """Whether the write gets given up, if this attempt to send it fails as well."""
+        return self.attempts + 1 >= MAX_ATTEMPTS
+
+
+class WriteQueue:
+    """A durable write-ahead queue for the creations, modifications and deletions of events.
+
+    The writes are journaled in a sqlite database before the intents confirm them, so they survive restarts of the
+    skill, and are sent to the server by a background worker. Failing writes are retried with an exponential backoff
+    until MAX_ATTEMPTS is reached and writes to the same event are always sent in the order they were made.
+    """
+
+    def __init__(self, path: str, send, log=None):
+        """Inits the queue and opens its journal.
+
+        Args:
+            path: A string containing the path of the journal file.
+            send: A function taking a list of due writes and returning a list with one of DONE, FAILED or RETRY for
+                each of them. Writes on their last attempt are given up, if RETRY is returned for them.
+            log: Optional; A logger for failing writes.
+        """
+        self.send = send
+        self.log = log
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = False
+        self._thread = None
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS writes (id INTEGER PRIMARY KEY AUTOINCREMENT, calendar TEXT, "
+                         "kind TEXT, href TEXT, payload TEXT, attempts INTEGER DEFAULT 0, due REAL DEFAULT 0)")
+
+
+    def start(self):
+        """Starts the background worker, which also sends the writes left over from the last run."""
+        self._thread = threading.Thread(target=self._run, name="CalendarWriteQueue", daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        """Stops the background worker and closes the journal. Unsent writes stay in the journal."""
+        self._stopped = True
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            if self._thread.is_alive():
+                # the worker is still waiting for the server and needs the journal to finish its writes
+                return
+        with self._lock:
+            self._db.close()
+
+
+    def push(self, calendar: str, kind: str, href: str, payload: dict):
+        """Journals a write and wakes up the worker to send it.
+
+        Args:
+            calendar: A string containing the url of the calendar.
+            kind: A string containing the kind of the write (create, modify or delete).
+            href: A string containing the href of the written event.
+            payload: A dict containing the data needed to send the write, it has to be serializable to json.
+        """
+        self.push_many(calendar, kind, [(href, payload)])
+
+
+    def push_many(self, calendar: str, kind: str, writes):
+        """Journals multiple writes of the same kind in one transaction and wakes up the worker once, so it sends
+        them together, e.g. all deletions of a bulk delete.
+
+        Args:
+            calendar: A string containing the url of the calendar.
+            kind: A string containing the kind of the writes (create, modify or delete).
+            writes: A list of tuples containing the href of the written event and the payload of the write.
+        """
+        with self._lock:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany("INSERT INTO writes (calendar, kind, href, payload) VALUES (?, ?, ?, ?)",
+                                     [(calendar, kind, href, json.dumps(payload)) for href, payload in writes])
+        self._wakeup.set()
+
+
+    def pending(self, calendar: str):
+        """Gets the events of a calendar with unsent writes.
+
+        Args:
+            calendar: A string containing the url of the calendar.
+
+        Returns:
+            A dict containing the number of unsent writes by the href of the event.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT href, COUNT(*) FROM writes WHERE calendar = ? GROUP BY href",
+                                    (calendar,)).fetchall()
+        return dict(rows)
+
+
+    def _due(self):
+        """Gets the writes which can be sent now. A write waits as long as an earlier write of the same event is in
+        the queue.
+
+        Returns:
+            A tuple containing the list of due writes and the time until the next write gets due in seconds.
+        """
+        with self._lock:
+            rows = self._db.execute("SELECT id, calendar, kind, href, payload, attempts, due FROM writes "
+                                    "ORDER BY id").fetchall()
+        now = time.time()
+        due = []
+        blocked = set()
+        next_due = None
+        for id, calendar, kind, href, payload, attempts, due_at in rows:
+            if href in blocked:
+                continue
+            blocked.add(href)
+            if due_at <= now:
+                due.append(Write(id, calendar, kind, href, json.loads(payload), attempts))
+            else:
+                next_due = due_at - now if next_due is None else min(next_due, due_at - now)
+        return due, next_due
+
+
+    def _run(self):
+        while not self._stopped:
+            writes, next_due = self._due()
+            if len(writes) > 0:
+                try:
+                    results = self.send(writes)
+                except Exception:
+                    if self.log is not None:
+                        self.log.exception("Sending the calendar writes failed")
+                    results = [RETRY] * len(writes)
+                self._finish(writes, results)
+                continue
+            self._wakeup.wait(next_due)
+            self._wakeup.clear()
+
+
+    def _finish(self, writes, results):
+        """Removes the sent writes from the journal and reschedules the writes to retry."""
+        now = time.time()
+        with self._lock:
+            for write, result in zip(writes, results):
+                if result == RETRY and write.last_attempt:
+                    if self.log is not None:
+                        self.log.error(f"Giving up to {write.kind} {write.href} after {MAX_ATTEMPTS} attempts")
+                    self._db.execute("DELETE FROM writes WHERE id = ?", (write.id,))
+                elif result == RETRY:
+                    delay = min(RETRY_DELAY * 2 ** write.attempts, MAX_RETRY_DELAY)
+                    self._db.execute("UPDATE writes SET attempts = attempts + 1, due = ? WHERE id = ?",
+                                     (now + delay, write.id))
+                else:
+                    self._db.execute("DELETE FROM writes WHERE id = ?", (write.id,))
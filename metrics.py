@@ -0,0 +1,208 @@
+from collections import deque
+from contextlib import contextmanager
+import cProfile
+import functools
+import json
+import math
+import os
+import threading
+import time
+
+# number of latest durations per stage the percentiles are computed from
+HISTORY = 1000
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(values, p: float):
+    """Gets a percentile of the given values by the nearest rank method.
+
+    Args:
+        values: A sorted list of floats.
+        p: A float between 0 and 100.
+
+    Returns:
+        The percentile or None if there are no values.
+    """
+    if len(values) == 0:
+        return None
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+class Trace:
+    """The durations of the stages of a single intent run."""
+
+    def __init__(self, intent: str):
+        """Inits an empty trace.
+
+        Args:
+            intent: A string containing the name of the intent.
+        """
+        self.intent = intent
+        self.started = time.time()
+        self.spans = []
+        self._lock = threading.Lock()
+
+
+    def add(self, stage: str, duration: float):
+        """Adds the duration of a stage. A stage running multiple times adds one duration per run."""
+        with self._lock:
+            self.spans.append((stage, duration))
+
+
+    def totals(self):
+        """Gets the summed up duration of every stage in seconds by the stage name."""
+        totals = {}
+        with self._lock:
+            for stage, duration in self.spans:
+                totals[stage] = totals.get(stage, 0.0) + duration
+        return totals
+
+
+class Metrics:
+    """Timing spans of the intent handlers aggregated into rolling latency histograms.
+
+    The handlers run inside an intent span, every stage inside of it (e.g. the discovery or a REPORT request) adds its
+    duration to the trace of the intent run. The durations of the stages and intents are kept for the latest runs, so
+    the percentiles show the current latency. Finished traces are handed to a listener, e.g. to send them over the
+    message bus, and can be appended to a metrics file. A single intent run can be profiled with cProfile.
+    """
+
+    def __init__(self, size: int = HISTORY):
+        """Inits empty histograms.
+
+        Args:
+            size: Optional; The number of latest durations kept per stage.
+        """
+        self.size = size
+        # function called with a dict describing every finished intent run
+        self.listener = None
+        # path of a file the traces get appended to as json lines, None to not write them
+        self.path = None
+        # directory the profiles are written to
+        self.profile_dir = "."
+        self._histograms = {}
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._profile_next = False
+
+
+    def current(self):
+        """Gets the trace of the intent run of the current thread or None outside of intents."""
+        return getattr(self._local, "trace", None)
+
+
+    @contextmanager
+    def span(self, stage: str):
+        """Measures the duration of a stage and adds it to the current trace and the histograms.
+
+        Args:
+            stage: A string containing the name of the stage.
+        """
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            trace = self.current()
+            if trace is not None:
+                trace.add(stage, duration)
+                self.record(f"{trace.intent}.{stage}", duration)
+            self.record(stage, duration)
+
+
+    @contextmanager
+    def intent(self, name: str):
+        """Runs the block as one traced intent run. The run gets profiled, if profiling was switched on.
+
+        Args:
+            name: A string containing the name of the intent.
+        """
+        trace = Trace(name)
+        self._local.trace = trace
+        with self._lock:
+            profiler = cProfile.Profile() if self._profile_next else None
+            self._profile_next = False
+        started = time.perf_counter()
+        if profiler is not None:
+            profiler.enable()
+        try:
+            yield trace
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            duration = time.perf_counter() - started
+            self._local.trace = None
+            self.record(f"{name}.total", duration)
+            if profiler is not None:
+                profiler.dump_stats(os.path.join(self.profile_dir, f"profile-{name}-{int(trace.started)}.prof"))
+            self._finish(trace, duration)
+
+
+    def bind(self, function):
+        """Wraps a function, so its spans are added to the current trace even if it runs in another thread.
+
+        Args:
+            function: The function to wrap.
+
+        Returns:
+            The wrapped function.
+        """
+        trace = self.current()
+
+        @functools.wraps(function)
+        def traced(*args, **kwargs):
+            previous = self.current()
+            self._local.trace = trace
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self._local.trace = previous
+        return traced
+
+
+    def record(self, key: str, duration: float):
+        """Adds a duration to a histogram.
+
+        Args:
+            key: A string containing the name of the histogram.
+            duration: A float containing the duration in seconds.
+        """
+        with self._lock:
+            history = self._histograms.get(key)
+            if history is None:
+                history = self._histograms[key] = deque(maxlen=self.size)
+            history.append(duration)
+
+
+    def summary(self):
+        """Gets the percentiles of all histograms.
+
+        Returns:
+            A dict containing a dict with the number of durations and the p50, p95 and p99 in milliseconds by the
+            name of the histogram.
+        """
+        with self._lock:
+            histograms = {key: sorted(history) for key, history in self._histograms.items()}
+        return {key: dict(count=len(values), **{f"p{p}": round(percentile(values, p) * 1000, 3) for p in PERCENTILES})
+                for key, values in histograms.items()}
+
+
+    def profile_next(self):
+        """Switches on profiling for the next intent run."""
+        with self._lock:
+            self._profile_next = True
+
+
+    def _finish(self, trace: Trace, duration: float):
+        """Hands a finished trace to the listener and appends it to the metrics file."""
+        record = {"intent": trace.intent, "started": trace.started, "total_ms": round(duration * 1000, 3),
+                  "stages_ms": {stage: round(total * 1000, 3) for stage, total in trace.totals().items()}}
+        if self.listener is not None:
+            self.listener(record)
+        if self.path is not None:
+            try:
+                with self._lock, open(self.path, "a") as file:
+                    file.write(json.dumps(record) + "\n")
+            except OSError:
+                # the metrics must never break an intent
+                pass
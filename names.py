@@ -0,0 +1,253 @@
+from collections import Counter
+from itertools import combinations
+import re
+
+WORD = re.compile(r"\w+")
+# The number of shortest names containing a similar word which get scored
+MAX_WORD_NAMES = 32
+# The number of indexed words which are looked at for each misheard word
+MAX_SIMILAR_WORDS = 8
+# Names whose words are all said are looked up by every subset of the said words up to this number of words
+MAX_SUBSET_WORDS = 8
+
+
+def tokenize(name: str):
+    """Splits a name into its lowercased words.
+
+    Args:
+        name: A string containing the name.
+
+    Returns:
+        A frozenset of the words.
+    """
+    return frozenset(WORD.findall(name.lower()))
+
+
+def trigrams(tokens):
+    """Gets the trigrams of the given words. The words are padded, so short words and word starts get trigrams too.
+
+    Args:
+        tokens: An iterable of words.
+
+    Returns:
+        A frozenset of the trigrams.
+    """
+    grams = set()
+    for token in tokens:
+        padded = f"  {token} "
+        grams.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return frozenset(grams)
+
+
+class NameIndex:
+    """An inverted index from the words of event names to the names and from the names to the events.
+
+    The index is built over the distinct lowercased names, so events with repeated names (e.g. a weekly meeting) cost
+    only one entry in the posting lists. It gets updated in place when events are added, renamed or removed and
+    finds names which sound similar to a misheard name without looking at every event. Misheard words are looked up
+    by the trigrams of the distinct words, and only the shortest names containing a similar word get scored, since
+    they are the ones with the best scores. Names are bucketed by their number of trigrams for this.
+    """
+
+    def __init__(self):
+        """Inits an empty index"""
+        self._hrefs = {}
+        self._grams = {}
+        self._tokens = {}
+        self._names = {}
+        self._words = {}
+        self._spellings = {}
+        self._postings = {}
+        self._by_tokens = {}
+
+
+    def add(self, href: str, name: str):
+        """Adds an event to the index or moves it to its new name, if it is already contained.
+
+        Args:
+            href: A string containing the href of the event.
+            name: A string containing the lowercased name of the event.
+        """
+        if self._names.get(href) == name:
+            return
+        self.remove(href)
+        self._names[href] = name
+        hrefs = self._hrefs.get(name)
+        if hrefs is None:
+            hrefs = self._hrefs[name] = set()
+            tokens = self._tokens[name] = tokenize(name)
+            grams = self._grams[name] = trigrams(tokens)
+            self._by_tokens.setdefault(tokens, set()).add(name)
+            for token in tokens:
+                sizes = self._words.get(token)
+                if sizes is None:
+                    sizes = self._words[token] = {}
+                    spelling = self._spellings[token] = trigrams((token,))
+                    for gram in spelling:
+                        self._postings.setdefault(gram, set()).add(token)
+                sizes.setdefault(len(grams), set()).add(name)
+        hrefs.add(href)
+
+
+    def remove(self, href: str):
+        """Removes an event from the index. Does nothing if the event isn't contained.
+
+        Args:
+            href: A string containing the href of the event.
+        """
+        name = self._names.pop(href, None)
+        if name is None:
+            return
+        hrefs = self._hrefs[name]
+        hrefs.discard(href)
+        if len(hrefs) == 0:
+            del self._hrefs[name]
+            tokens = self._tokens.pop(name)
+            size = len(self._grams.pop(name))
+            self._discard(self._by_tokens, tokens, name)
+            for token in tokens:
+                sizes = self._words[token]
+                self._discard(sizes, size, name)
+                if len(sizes) == 0:
+                    del self._words[token]
+                    for gram in self._spellings.pop(token):
+                        self._discard(self._postings, gram, token)
+
+
+    @staticmethod
+    def _discard(postings: dict, key, value):
+        """Removes a value from a posting list and drops the list once it is empty.
+
+        Args:
+            postings: A dict mapping the keys to sets of values.
+            key: The key of the posting list.
+            value: The value to remove.
+        """
+        values = postings[key]
+        values.discard(value)
+        if len(values) == 0:
+            del postings[key]
+
+
+    def search(self, name: str, threshold: float = 0.4, limit: int = 5):
+        """Finds the names which are similar to the given name. Names are scored by the dice coefficient of their
+        trigrams, names containing all words of the searched name or whose words are all contained in it get boosted.
+        Only the shortest names containing a word which is similar to a searched word get scored, so a long name might
+        be missed if there are many shorter names with the same words.
+
+        Args:
+            name: A string containing the searched name.
+            threshold: Optional; The minimal score of a found name between 0 and 1.
+            limit: Optional; The maximum number of names to return.
+
+        Returns:
+            A list of tuples containing the found name, its score and the set of hrefs of its events, sorted by the
+            score with the best match first.
+        """
+        name = name.lower().strip()
+        if name in self._hrefs:
+            return [(name, 1.0, set(self._hrefs[name]))]
+
+        tokens = tokenize(name)
+        grams = trigrams(tokens)
+        if len(grams) == 0:
+            return []
+        candidates = self._made_of(tokens)
+        candidates.update(self._containing(tokens, limit))
+        for word in self._similar_words(tokens, threshold):
+            candidates.update(self._shortest(word, MAX_WORD_NAMES))
+
+        results = []
+        for candidate in candidates:
+            candidate_grams = self._grams[candidate]
+            score = 2 * len(grams & candidate_grams) / (len(grams) + len(candidate_grams))
+            candidate_tokens = self._tokens[candidate]
+            if tokens <= candidate_tokens or candidate_tokens <= tokens:
+                score = (1 + score) / 2
+            if score >= threshold:
+                results.append((candidate, score))
+        results.sort(key=lambda result: result[1], reverse=True)
+        return [(candidate, score, set(self._hrefs[candidate])) for candidate, score in results[:limit]]
+
+
+    def _similar_words(self, tokens, threshold: float):
+        """Gets the indexed words which are similar to the given words by the dice coefficient of their trigrams.
+
+        Args:
+            tokens: A frozenset of the searched words.
+            threshold: The minimal score of a similar word between 0 and 1.
+
+        Returns:
+            A set of the similar words, containing the searched words themselves if they are indexed.
+        """
+        similar = set()
+        for token in tokens:
+            spelling = trigrams((token,))
+            shared = Counter()
+            for gram in spelling:
+                shared.update(self._postings.get(gram, ()))
+            scores = {word: 2 * count / (len(spelling) + len(self._spellings[word])) for word, count in shared.items()}
+            words = sorted((word for word in scores if scores[word] >= threshold), key=scores.get, reverse=True)
+            similar.update(words[:MAX_SIMILAR_WORDS])
+        return similar
+
+
+    def _shortest(self, word: str, limit: int):
+        """Gets the names containing the given word with the fewest trigrams.
+
+        Args:
+            word: A string containing the indexed word.
+            limit: The maximum number of names to return. All names of the last used size are returned.
+
+        Returns:
+            A list of the names.
+        """
+        names = []
+        sizes = self._words[word]
+        for size in sorted(sizes):
+            names.extend(sizes[size])
+            if len(names) >= limit:
+                break
+        return names
+
+
+    def _containing(self, tokens, limit: int):
+        """Gets the shortest names containing all of the given words.
+
+        Args:
+            tokens: A frozenset of the searched words.
+            limit: The maximum number of names to return. All names of the last used size are returned.
+
+        Returns:
+            A list of the names.
+        """
+        if any(token not in self._words for token in tokens):
+            return []
+        rarest = min(tokens, key=lambda token: sum(len(names) for names in self._words[token].values()))
+        names = []
+        sizes = self._words[rarest]
+        for size in sorted(sizes):
+            names.extend(name for name in sizes[size] if tokens <= self._tokens[name])
+            if len(names) >= limit:
+                break
+        return names
+
+
+    def _made_of(self, tokens):
+        """Gets the names whose words are all contained in the given words.
+
+        Args:
+            tokens: A frozenset of the searched words.
+
+        Returns:
+            A set of the names.
+        """
+        tokens = [token for token in tokens if token in self._words]
+        if len(tokens) > MAX_SUBSET_WORDS:
+            return {name for token in tokens for names in self._words[token].values() for name in names
+                    if self._tokens[name] <= set(tokens)}
+        names = set()
+        for length in range(1, len(tokens) + 1):
+            for subset in combinations(tokens, length):
+                names.update(self._by_tokens.get(frozenset(subset), ()))
+        return names
@@ -0,0 +1,210 @@
+from datetime import datetime, time, timedelta, timezone
+
+from dateutil import tz
+
+
+def to_timestamp(value):
+    """Converts the value of a date property to a utc timestamp. Dates and naive datetimes are interpreted in the
+    local timezone.
+
+    Args:
+        value: A date or datetime object.
+
+    Returns:
+        A float representing the utc timestamp.
+    """
+    if not isinstance(value, datetime):
+        value = datetime.combine(value, time.min)
+    return value.astimezone().timestamp()
+
+
+def zone_name(value: datetime):
+    """Gets the name of the timezone of a datetime, if the timezone can be looked up by it again.
+
+    Args:
+        value: A datetime object with timezone.
+
+    Returns:
+        A string containing the name of the timezone or None if it has no known name.
+    """
+    for attribute in ("zone", "_tzid", "tzid", "_filename"):
+        name = getattr(value.tzinfo, attribute, None)
+        if isinstance(name, str):
+            # dateutil keeps the path of the zoneinfo file the timezone was read from
+            name = name.rpartition("zoneinfo/")[2]
+        if name and tz.gettz(name) is not None:
+            return name
+    return None
+
+
+def is_local(value: datetime):
+    """Tells whether a datetime is in the local timezone, e.g. after converting it with astimezone()."""
+    if isinstance(value.tzinfo, tz.tzlocal):
+        return True
+    return isinstance(value.tzinfo, timezone) and value.tzinfo != timezone.utc and \
+        value.utcoffset() == value.astimezone().utcoffset()
+
+
+def format_date_line(name: str, values):
+    """Creates the content line of a date property, e.g. to keep the recurrence of an event parsed by vobject.
+    Datetimes keep the name of their timezone, so the rules get repeated in it across the changes of daylight saving
+    time. Datetimes in the local timezone are written as floating time, which is taken as local time again. Other
+    datetimes are written in utc, since their timezone might only be defined in the payload.
+
+    Args:
+        name: A string containing the name of the property.
+        values: A list of date or datetime objects.
+
+    Returns:
+        A string containing the content line.
+    """
+    if all(not isinstance(value, datetime) for value in values):
+        return f"{name};VALUE=DATE:" + ",".join(value.strftime("%Y%m%d") for value in values)
+    first = values[0]
+    if first.tzinfo is None:
+        return f"{name}:" + ",".join(value.strftime("%Y%m%dT%H%M%S") for value in values)
+    tzid = zone_name(first)
+    if tzid is not None:
+        zone = tz.gettz(tzid)
+        return f"{name};TZID={tzid}:" + ",".join(value.astimezone(zone).strftime("%Y%m%dT%H%M%S")
+                                                 for value in values)
+    if is_local(first):
+        return f"{name}:" + ",".join(value.astimezone().strftime("%Y%m%dT%H%M%S") for value in values)
+    return f"{name}:" + ",".join(value.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ") for value in values)
+
+
+class EventRecord:
+    """A compact, read-only summary of an event.
+
+    The record is created once when an event gets loaded and holds everything the intent handlers need to filter,
+    sort and speak about events. The full icalendar object is only parsed again when an event gets edited.
+    """
+
+    __slots__ = ("start", "end", "all_day", "summary", "summary_lower", "uid", "href", "etag", "recurrence",
+                 "overrides")
+
+    def __init__(self, start: float, end: float, all_day: bool, summary: str, uid: str, href: str, etag: str = None,
+                 recurrence: str = None, overrides: tuple = ()):
+        """Inits the record.
+
+        Args:
+            start: A float representing the start of the event as utc timestamp.
+            end: A float representing the end of the event as utc timestamp.
+            all_day: Boolean telling whether the event lasts whole days.
+            summary: A string containing the name of the event.
+            uid: A string containing the uid of the event.
+            href: A string containing the href of the event on the server.
+            etag: Optional; A string containing the etag of the event on the server.
+            recurrence: Optional; A string containing the DTSTART, RRULE, RDATE and EXDATE lines of a recurring event.
+            overrides: Optional; A tuple containing the start, end and name (None if unchanged) of the overridden
+                instances of a recurring event.
+        """
+        self.start = start
+        self.end = end
+        self.all_day = all_day
+        self.summary = summary
+        self.summary_lower = summary.lower()
+        self.uid = uid
+        self.href = href
+        self.etag = etag
+        self.recurrence = recurrence
+        self.overrides = overrides
+
+
+    @property
+    def start_datetime(self):
+        """The start of the event as datetime in the local timezone."""
+        return datetime.fromtimestamp(self.start).astimezone()
+
+
+    @property
+    def end_datetime(self):
+        """The end of the event as datetime in the local timezone."""
+        return datetime.fromtimestamp(self.end).astimezone()
+
+
+    @property
+    def recurring(self):
+        """Boolean telling whether the record is the master of a recurring event."""
+        return self.recurrence is not None
+
+
+    def occurrence(self, start: float, end: float = None, summary: str = None):
+        """Creates the record of a single instance of the recurring event.
+
+        Args:
+            start: A float representing the start of the instance as utc timestamp.
+            end: Optional; A float representing the end of the instance as utc timestamp. Defaults to the start plus
+                the duration of the event.
+            summary: Optional; A string containing the name of the instance. Defaults to the name of the event.
+
+        Returns:
+            The created record.
+        """
+        return EventRecord(start, start + self.end - self.start if end is None else end, self.all_day,
+                           self.summary if summary is None else summary, self.uid, self.href, self.etag)
+
+
+    @classmethod
+    def from_vevent(cls, vevent, href: str, etag: str = None, overrides=()):
+        """Creates a record from a parsed vevent component.
+
+        Args:
+            vevent: A vobject component containing the event.
+            href: A string containing the href of the event on the server.
+            etag: Optional; A string containing the etag of the event on the server.
+            overrides: Optional; A list of the vobject components of the overridden instances, if the event recurs.
+
+        Returns:
+            The created record.
+        """
+        start, end = cls._vevent_times(vevent)
+        all_day = not isinstance(start, datetime)
+        summary = vevent.summary.value if hasattr(vevent, "summary") else ""
+        uid = vevent.uid.value if hasattr(vevent, "uid") else href
+
+        recurrence = None
+        instances = []
+        if "rrule" in vevent.contents or "rdate" in vevent.contents:
+            lines = [format_date_line("DTSTART", [start])]
+            lines += ["RRULE:" + line.value for line in vevent.contents.get("rrule", [])]
+            lines += [format_date_line("RDATE", line.value) for line in vevent.contents.get("rdate", [])]
+            lines += [format_date_line("EXDATE", line.value) for line in vevent.contents.get("exdate", [])]
+            for override in overrides:
+                lines.append(format_date_line("EXDATE", [override.recurrence_id.value]))
+                override_start, override_end = cls._vevent_times(override)
+                instances.append((to_timestamp(override_start), to_timestamp(override_end),
+                                  override.summary.value if hasattr(override, "summary") else None))
+            recurrence = "\n".join(lines)
+        return cls(to_timestamp(start), to_timestamp(end), all_day, summary, uid, href, etag, recurrence,
+                   tuple(instances))
+
+
+    @classmethod
+    def from_vcalendar(cls, vcalendar, href: str, etag: str = None):
+        """Creates a record from a parsed calendar object, whose master event may be followed by overridden instances.
+
+        Args:
+            vcalendar: A vobject component containing the calendar object.
+            href: A string containing the href of the event on the server.
+            etag: Optional; A string containing the etag of the event on the server.
+
+        Returns:
+            The created record.
+        """
+        vevents = vcalendar.contents.get("vevent", [])
+        master = next((vevent for vevent in vevents if not hasattr(vevent, "recurrence_id")), vevents[0])
+        return cls.from_vevent(master, href, etag, [vevent for vevent in vevents if vevent is not master and
+                                                    hasattr(vevent, "recurrence_id")])
+
+
+    @staticmethod
+    def _vevent_times(vevent):
+        start = vevent.dtstart.value
+        if hasattr(vevent, "dtend"):
+            end = vevent.dtend.value
+        elif hasattr(vevent, "duration"):
+            end = start + vevent.duration.value
+        else:
+            end = start + timedelta(days=1) if not isinstance(start, datetime) else start
+        return start, end
@@ -0,0 +1,272 @@
+from collections import OrderedDict
+from datetime import datetime, time, timedelta
+from functools import lru_cache
+import math
+import re
+import threading
+
+from dateutil import tz
+from dateutil.rrule import rrulestr, rruleset
+
+from .ical import split_property, parse_date_value, UnsupportedEvent
+from .records import to_timestamp
+
+# length of the windows in which the instances of recurring events are expanded and memoized in seconds
+WINDOW = 28 * 24 * 3600
+# maximum number of memoized windows of all recurring events
+MEMO_SIZE = 4096
+
+# length of one period of the rule frequencies, which allow to skip whole periods without changing the instances
+PERIODS = {"WEEKLY": timedelta(weeks=1), "DAILY": timedelta(days=1), "HOURLY": timedelta(hours=1),
+           "MINUTELY": timedelta(minutes=1), "SECONDLY": timedelta(seconds=1)}
+UNTIL = re.compile(r"UNTIL=([0-9TZ]+)", re.IGNORECASE)
+
+
+def align(value, dtstart: datetime):
+    """Converts a date property to the kind of datetime used by the rule, since naive and aware datetimes can't be
+    compared. Dates and naive datetimes are taken as local time.
+
+    Args:
+        value: A date or datetime object.
+        dtstart: A datetime object containing the start of the recurring event.
+
+    Returns:
+        The converted datetime object.
+    """
+    if not isinstance(value, datetime):
+        return datetime.combine(value, dtstart.timetz())
+    if value.tzinfo is not None and dtstart.tzinfo is None:
+        return value.astimezone(tz.tzlocal()).replace(tzinfo=None)
+    if value.tzinfo is None and dtstart.tzinfo is not None:
+        return value.replace(tzinfo=tz.tzlocal())
+    return value
+
+
+@lru_cache(maxsize=256)
+def parse_recurrence(recurrence: str):
+    """Parses the recurrence lines of an event. Dates are converted to datetimes at midnight like the rules do.
+
+    Args:
+        recurrence: A string containing the DTSTART, RRULE, RDATE and EXDATE lines of the event.
+
+    Returns:
+        A tuple containing the start as datetime, a tuple of the RRULE values and tuples of the RDATE and EXDATE
+        datetimes.
+
+    Raises:
+        UnsupportedEvent: The recurrence uses an unknown timezone.
+    """
+    dtstart = None
+    rules = []
+    rdates = []
+    exdates = []
+    for line in recurrence.splitlines():
+        name, parameters, value = split_property(line)
+        if name == "RRULE":
+            rules.append(value)
+        elif name in ("DTSTART", "RDATE", "EXDATE"):
+            values = [parse_date_value(part, parameters) for part in value.split(",") if part.strip() != ""]
+            if name == "DTSTART":
+                dtstart = values[0]
+            else:
+                (rdates if name == "RDATE" else exdates).extend(values)
+    if dtstart is None:
+        raise UnsupportedEvent("Recurring event without start")
+    if not isinstance(dtstart, datetime):
+        dtstart = datetime.combine(dtstart, time.min)
+    return (dtstart, tuple(rules), tuple(align(value, dtstart) for value in rdates),
+            tuple(align(value, dtstart) for value in exdates))
+
+
+def skip_periods(rule: str, dtstart: datetime, after: datetime):
+    """Moves the start of a rule over the whole periods before the given time, so the instances before it don't get
+    generated. Only rules with a fixed period length and without COUNT can be moved without changing their instances.
+
+    Args:
+        rule: A string containing the RRULE value.
+        dtstart: A datetime object containing the start of the rule.
+        after: A datetime object containing the time from which the instances are needed.
+
+    Returns:
+        A datetime object containing the start to expand the rule from.
+    """
+    parts = dict(part.upper().partition("=")[::2] for part in rule.split(";"))
+    period = PERIODS.get(parts.get("FREQ"))
+    if period is None or "COUNT" in parts or after <= dtstart:
+        return dtstart
+    period *= int(parts.get("INTERVAL") or 1)
+    # one period is kept in front of the window, so instances moved by daylight saving time aren't lost
+    skipped = math.floor((after - dtstart) / period) - 1
+    return dtstart + skipped * period if skipped > 0 else dtstart
+
+
+def align_until(rule: str, dtstart: datetime):
+    """Converts the UNTIL part of a rule to the kind of datetime used by its start, since dateutil refuses mixing
+    them."""
+    def replace(match):
+        until = align(parse_date_value(match.group(1), {}), dtstart)
+        if until.tzinfo is None:
+            return f"UNTIL={until:%Y%m%dT%H%M%S}"
+        return f"UNTIL={until.astimezone(tz.UTC):%Y%m%dT%H%M%SZ}"
+    return UNTIL.sub(replace, rule)
+
+
+def expand(record, start: float, end: float):
+    """Expands the instances of a recurring event starting in the given time span on the device.
+
+    Args:
+        record: The record of the recurring event.
+        start: A float representing the minimal start of the instances as utc timestamp.
+        end: A float representing the end of the time span (exclusive) as utc timestamp.
+
+    Returns:
+        A list of tuples containing the start, end and name of the instances sorted by their start. End and name
+        are None, if they are the ones of the event.
+
+    Raises:
+        UnsupportedEvent: The recurrence can't be expanded on the device.
+    """
+    dtstart, rules, rdates, exdates = parse_recurrence(record.recurrence)
+    # a day of margin on both sides covers the changes of the utc offset, the instances get filtered exactly below
+    after = datetime.fromtimestamp(start, dtstart.tzinfo) - timedelta(days=1)
+    before = datetime.fromtimestamp(end, dtstart.tzinfo) + timedelta(days=1)
+
+    instances = rruleset()
+    try:
+        for rule in rules:
+            instances.rrule(rrulestr(align_until(rule, dtstart), dtstart=skip_periods(rule, dtstart, after)))
+    except ValueError as e:
+        raise UnsupportedEvent(f"Invalid recurrence rule: {e}")
+    # the start is an instance even if the rule doesn't match it
+    instances.rdate(dtstart)
+    for value in rdates:
+        instances.rdate(value)
+    for value in exdates:
+        instances.exdate(value)
+
+    expanded = [(timestamp, None, None) for timestamp in map(to_timestamp, instances.between(after, before, inc=True))
+                if start <= timestamp < end]
+    expanded.extend(override for override in record.overrides if start <= override[0] < end)
+    expanded.sort(key=lambda instance: instance[0])
+    return expanded
+
+
+class RecurrenceExpander:
+    """Expands the instances of recurring events and memoizes them.
+
+    The instances are expanded in fixed windows and memoized by the uid, etag and window of the event, so a query
+    only expands the windows it didn't see before and a weekly meeting running for years never gets expanded over its
+    whole history. The least recently used windows are evicted first. The instances are taken from the server, if it
+    supports expanding them, otherwise they are expanded on the device.
+    """
+
+    def __init__(self, fetch=None, size: int = MEMO_SIZE, log=None):
+        """Inits the expander with an empty memo.
+
+        Args:
+            fetch: Optional; A function taking the start and end of a time span as utc timestamps and returning a dict
+                containing a tuple of the etag and the instances of every recurring event in it by its href, or None
+                if the server can't expand them. Events without etag get expanded on the device.
+            size: Optional; The maximum number of memoized windows.
+            log: Optional; A logger for events which can't be expanded.
+        """
+        self.fetch = fetch
+        self.size = size
+        self.log = log
+        self._memo = OrderedDict()
+        self._lock = threading.Lock()
+
+
+    def between(self, records, start: float, end: float):
+        """Finds the instances of recurring events starting in the given time span.
+
+        Args:
+            records: A list of the records of the recurring events.
+            start: A float representing the minimal start of the instances as utc timestamp.
+            end: A float representing the maximum start of the instances as utc timestamp.
+
+        Returns:
+            A list of the event records of the instances sorted by their start.
+        """
+        windows = range(math.floor(start / WINDOW), math.floor(end / WINDOW) + 1)
+        records = [record for record in records if record.start <= end]
+        found_windows = {}
+        missing = []
+        with self._lock:
+            for window in windows:
+                for record in records:
+                    # the windows before the start of an event can't contain any of its instances
+                    if record.start >= (window + 1) * WINDOW:
+                        continue
+                    key = (record.uid, record.etag, window)
+                    instances = self._memo.get(key)
+                    if instances is None:
+                        missing.append((record, window))
+                    else:
+                        self._memo.move_to_end(key)
+                        found_windows[key] = instances
+        if len(missing) > 0:
+            # the expanded windows are taken from the result, the memo may have evicted them already if the query
+            # needed more windows than it can hold
+            found_windows.update(self._expand(missing))
+
+        found = []
+        for window in windows:
+            for record in records:
+                instances = found_windows.get((record.uid, record.etag, window))
+                if instances is not None:
+                    found.extend(record.occurrence(*instance) for instance in instances
+                                 if start <= instance[0] <= end)
+        found.sort(key=lambda occurrence: occurrence.start)
+        return found
+
+
+    def _expand(self, missing):
+        """Expands the given windows of recurring events and memoizes them. All windows are requested from the server
+        with a single request, events it didn't expand are expanded on the device.
+
+        Args:
+            missing: A list of tuples containing the record of a recurring event and the number of the window.
+
+        Returns:
+            A dict containing the instances of the expanded windows by the uid, etag and number of the window.
+        """
+        expanded = {}
+        fetched = None
+        if self.fetch is not None:
+            first = min(window for _, window in missing)
+            last = max(window for _, window in missing)
+            try:
+                fetched = self.fetch(first * WINDOW, (last + 1) * WINDOW)
+            except Exception:
+                if self.log is not None:
+                    self.log.exception("Expanding the recurring events on the server failed")
+        for record, window in missing:
+            start = window * WINDOW
+            if fetched is not None and (record.href not in fetched or
+                                        fetched[record.href][0] is not None and fetched[record.href][0] == record.etag):
+                instances = [self._relative(record, instance) for instance in fetched.get(record.href, (None, []))[1]
+                             if start <= instance[0] < start + WINDOW]
+            else:
+                try:
+                    instances = expand(record, start, start + WINDOW)
+                except ValueError:
+                    if self.log is not None:
+                        self.log.warning(f"Can't expand the recurrence of {record.href}")
+                    instances = [(record.start, None, None)] if start <= record.start < start + WINDOW else []
+            expanded[(record.uid, record.etag, window)] = instances
+
+        with self._lock:
+            self._memo.update(expanded)
+            while len(self._memo) > self.size:
+                self._memo.popitem(last=False)
+        return expanded
+
+
+    @staticmethod
+    def _relative(record, instance):
+        """Drops the end and name of an instance expanded by the server, if they are the ones of the event, so local
+        changes of the event apply to the memoized instance as well."""
+        start, end, summary = instance
+        return (start, None if end - start == record.end - record.start else end,
+                None if summary == record.summary else summary)
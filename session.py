@@ -0,0 +1,181 @@
+import threading
+
+import caldav
+import requests
+from caldav.lib import error
+
+from .metrics import Metrics
+
+
+class CalDavSession:
+    """A long-lived connection to the nextcloud CalDav server.
+
+    The session keeps a single authenticated DAVClient (and with it one keep-alive HTTP connection pool) for the
+    whole lifetime of the skill. The principal and calendar-home urls are discovered once and the calendars found in
+    the calendar home are cached by their lowercased name, so the intent handlers don't pay for the discovery and the
+    TLS handshakes on every request.
+    """
+
+    def __init__(self, url: str, metrics: Metrics = None):
+        """Inits the session without connecting to the server.
+
+        Args:
+            url: A string containing the CalDav-Url including the user and password.
+            metrics: Optional; The metrics the durations of the requests are added to.
+        """
+        self.url = url
+        self.metrics = metrics or Metrics()
+        self._lock = threading.RLock()
+        self._client = None
+        self._principal_url = None
+        self._home_url = None
+        self._calendars = None
+        self._unknown = set()
+
+
+    @property
+    def client(self):
+        """The DAVClient used for all requests. Gets created on first use."""
+        with self._lock:
+            if self._client is None:
+                self._client = caldav.DAVClient(self.url)
+            return self._client
+
+
+    def call(self, function, *args, **kwargs):
+        """Calls the given function and retries it once with a fresh connection if the server refused the
+        credentials or the connection broke down.
+
+        Args:
+            function: A callable performing requests on the session.
+
+        Returns:
+            The return value of the function.
+        """
+        try:
+            return function(*args, **kwargs)
+        except (error.AuthorizationError, requests.exceptions.ConnectionError):
+            self.reconnect()
+            return function(*args, **kwargs)
+        except error.NotFoundError:
+            # the calendar home moved, so the cached urls are of no use anymore
+            self.invalidate()
+            return function(*args, **kwargs)
+
+
+    def reconnect(self):
+        """Replaces the DAVClient by a new one. The discovered urls are kept, so no rediscovery is needed."""
+        with self._lock:
+            if self._client is not None:
+                self._client.session.close()
+            self._client = None
+            if self._calendars is not None:
+                for calendar in self._calendars.values():
+                    calendar.client = self.client
+
+
+    def invalidate(self):
+        """Forgets the discovered urls and calendars, so they get discovered again on the next request."""
+        with self._lock:
+            self._principal_url = None
+            self._home_url = None
+            self._calendars = None
+            self._unknown.clear()
+
+
+    def calendars(self, refresh: bool = False):
+        """Gets the calendars of the user. Runs the discovery only once and returns the cached calendars afterwards.
+
+        Args:
+            refresh: Optional; Boolean to force listing the calendars of the calendar home again.
+
+        Returns:
+            A list of calendars.
+        """
+        with self._lock:
+            if self._calendars is None or refresh:
+                with self.metrics.span("discovery"):
+                    self._calendars = self.call(self._discover)
+                self._unknown.clear()
+            return list(self._calendars.values())
+
+
+    def calendar(self, name: str):
+        """Gets the calendar with the given name. Lists the calendars again, if the name is unknown, to pick up
+        calendars created since the last discovery. Names which are still unknown afterwards are remembered until the
+        next discovery, so e.g. a misspelled calendar in the settings doesn't list the calendars on every request.
+
+        Args:
+            name: A string containing the name of the calendar.
+
+        Returns:
+            The calendar with the given name or None if the user has no such calendar.
+        """
+        with self._lock:
+            self.calendars()
+            name = name.lower()
+            calendar = self._calendars.get(name)
+            if calendar is None and name not in self._unknown:
+                self.calendars(refresh=True)
+                calendar = self._calendars.get(name)
+                if calendar is None:
+                    self._unknown.add(name)
+            return calendar
+
+
+    def discovery(self):
+        """Gets the urls found by the discovery, e.g. to save them for the next start of the skill.
+
+        Returns:
+            A tuple containing the principal path, the calendar home path and a dict containing the calendar paths by
+            their name or None if the discovery didn't run yet.
+        """
+        with self._lock:
+            if self._home_url is None or self._calendars is None:
+                return None
+            principal = None if self._principal_url is None else self._principal_url.path
+            return principal, self._home_url.path, {calendar.name: calendar.url.path
+                                                    for calendar in self._calendars.values()}
+
+
+    def restore(self, principal: str, home: str, calendars: dict):
+        """Restores the urls of an earlier discovery without asking the server. They get discovered again, if the
+        server doesn't know them anymore.
+
+        Args:
+            principal: A string containing the principal path or None.
+            home: A string containing the calendar home path.
+            calendars: A dict containing the calendar paths by their name.
+        """
+        with self._lock:
+            if self._calendars is not None:
+                return
+            client = self.client
+            self._principal_url = None if principal is None else client.url.join(principal)
+            self._home_url = client.url.join(home)
+            self._calendars = {name.lower(): caldav.Calendar(client, url=path, name=name)
+                               for name, path in calendars.items()}
+            self._unknown.clear()
+
+
+    def close(self):
+        """Closes the connection pool of the session."""
+        with self._lock:
+            if self._client is not None:
+                self._client.session.close()
+            self._client = None
+
+
+    def _discover(self):
+        """Finds the calendar home of the user, if it isn't known yet, and lists its calendars.
+
+        Returns:
+            A dict containing the calendars by their lowercased name.
+        """
+        client = self.client
+        if self._home_url is None:
+            principal = client.principal()
+            self._principal_url = principal.url
+            self._home_url = principal.calendar_home_set.url
+        home = caldav.CalendarSet(client, url=self._home_url)
+        return {calendar.name.lower(): calendar for calendar in home.calendars() if calendar.name is not None}
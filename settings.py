@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from urllib.parse import quote
+
+try:
+    # older installations kept the login in a creds file next to the skill
+    import creds
+except ImportError:
+    creds = None
+
+
+def legacy_value(name: str):
+    """Gets a value of the old creds file or None if there is no such file or value."""
+    return getattr(creds, name, None) if creds is not None else None
+
+
+class CalendarSettings:
+    """The nextcloud login and the used calendar of the skill.
+
+    The values are taken from the skill settings and kept in memory, so the intents never read them from disk. The
+    calendar chosen by voice is saved to a small json file with an atomic write, so a restart keeps it and a crash
+    while saving never leaves a broken file. A calendar chosen in the skill settings afterwards replaces it.
+    """
+
+    def __init__(self, path: str, settings: dict):
+        """Inits the settings from the skill settings and the saved calendar choice.
+
+        Args:
+            path: A string containing the path of the file the calendar choice is saved to.
+            settings: A dict containing the skill settings.
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self.url = None
+        self.user = None
+        self.password = None
+        self.calendar = None
+        self._settings_calendar = None
+        self.update(settings)
+
+        saved = self._load()
+        # the saved choice only counts if the calendar in the skill settings wasn't changed since
+        if saved.get('calendar') and saved.get('settings_calendar') == self._settings_calendar:
+            self.calendar = saved['calendar']
+
+
+    @property
+    def dav_url(self):
+        """The CalDav-Url of the nextcloud including the user and password."""
+        with self._lock:
+            return (f"https://{quote(self.user or '', safe='')}:{quote(self.password or '', safe='')}@{self.url}"
+                    f"/nc/remote.php/dav")
+
+
+    @property
+    def account(self):
+        """A string identifying the nextcloud account without revealing it, e.g. to name files per account."""
+        with self._lock:
+            return hashlib.sha1(f"{self.user}@{self.url}".encode("utf-8")).hexdigest()[:12]
+
+
+    def update(self, settings: dict):
+        """Takes over changed skill settings.
+
+        Args:
+            settings: A dict containing the skill settings.
+
+        Returns:
+            Boolean telling whether the login changed, so the connection has to be opened again.
+        """
+        login = (settings.get('url') or legacy_value('url'), settings.get('username') or legacy_value('user'),
+                 settings.get('password') or legacy_value('pw'))
+        calendar = settings.get('calendar_name') or legacy_value('cal_name')
+        with self._lock:
+            changed = login != (self.url, self.user, self.password)
+            self.url, self.user, self.password = login
+            if calendar != self._settings_calendar:
+                self._settings_calendar = calendar
+                self.calendar = calendar
+            return changed
+
+
+    def select(self, calendar: str):
+        """Changes the used calendar and saves the choice.
+
+        Args:
+            calendar: A string containing the name of the calendar.
+        """
+        with self._lock:
+            self.calendar = calendar
+            self._save({'calendar': calendar, 'settings_calendar': self._settings_calendar})
+
+
+    def _load(self):
+        """Loads the saved calendar choice.
+
+        Returns:
+            A dict containing the saved values, which is empty if nothing was saved yet.
+        """
+        try:
+            with open(self.path, "r") as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+
+    def _save(self, values: dict):
+        """Writes the values to a temporary file and moves it over the old one, so the file is always complete."""
+        directory = os.path.dirname(self.path) or "."
+        descriptor, temporary = tempfile.mkstemp(dir=directory, prefix=".calendar-", suffix=".json")
+        try:
+            with os.fdopen(descriptor, "w") as file:
+                json.dump(values, file)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
@@ -0,0 +1,144 @@
+from contextlib import contextmanager
+import json
+import sqlite3
+import threading
+import time
+
+from .records import EventRecord
+
+# version of the database layout, snapshots of an other version are dropped
+SCHEMA_VERSION = 1
+
+
+class Snapshot:
+    """A sqlite copy of the discovered calendars and the stored events, so the skill doesn't start cold.
+
+    The snapshot keeps the urls found by the discovery, and the records, sync-token and ctag of every event store. It
+    gets updated with the changes since the last save only. After a restart the intents answer from the snapshot and
+    the stores are brought up to date with an incremental sync instead of downloading every event again. Urls are
+    saved as paths only, so the credentials contained in the CalDav-Url never end up on disk.
+    """
+
+    def __init__(self, path: str):
+        """Inits the snapshot and opens its database.
+
+        Args:
+            path: A string containing the path of the database file.
+        """
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        if self._db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+            # the snapshot is only a cache, so it gets filled again by the next sync
+            for table in ("meta", "calendars", "events"):
+                self._db.execute(f"DROP TABLE IF EXISTS {table}")
+            self._db.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS calendars (path TEXT PRIMARY KEY, name TEXT, sync_token TEXT, "
+                         "ctag TEXT, saved_at REAL)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS events (calendar TEXT, href TEXT, start REAL, end REAL, "
+                         "all_day INTEGER, summary TEXT, uid TEXT, etag TEXT, recurrence TEXT, overrides TEXT, "
+                         "PRIMARY KEY (calendar, href))")
+
+
+    def close(self):
+        """Closes the database."""
+        with self._lock:
+            self._db.close()
+
+
+    def load_discovery(self):
+        """Loads the urls found by the last discovery.
+
+        Returns:
+            A tuple containing the principal path, the calendar home path and a dict containing the calendar paths by
+            the name of the calendar or None if nothing was saved yet.
+        """
+        with self._lock:
+            meta = dict(self._db.execute("SELECT key, value FROM meta").fetchall())
+            calendars = dict(self._db.execute("SELECT name, path FROM calendars WHERE name IS NOT NULL").fetchall())
+        if "home" not in meta or len(calendars) == 0:
+            return None
+        return meta.get("principal"), meta["home"], calendars
+
+
+    def save_discovery(self, principal: str, home: str, calendars: dict):
+        """Saves the urls found by the discovery. Calendars which don't exist anymore are removed with their events.
+
+        Args:
+            principal: A string containing the principal path.
+            home: A string containing the calendar home path.
+            calendars: A dict containing the calendar paths by the name of the calendar.
+        """
+        with self._lock, self._transaction():
+            self._db.executemany("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)",
+                                 [("principal", principal), ("home", home)])
+            known = [path for path, in self._db.execute("SELECT path FROM calendars").fetchall()]
+            gone = [(path,) for path in known if path not in calendars.values()]
+            self._db.executemany("DELETE FROM calendars WHERE path = ?", gone)
+            self._db.executemany("DELETE FROM events WHERE calendar = ?", gone)
+            self._db.executemany("INSERT INTO calendars (path, name) VALUES (?, ?) "
+                                 "ON CONFLICT (path) DO UPDATE SET name = excluded.name",
+                                 [(path, name) for name, path in calendars.items()])
+
+
+    def load_calendar(self, path: str):
+        """Loads the saved state of an event store.
+
+        Args:
+            path: A string containing the path of the calendar.
+
+        Returns:
+            A tuple containing the list of event records, the sync-token, the ctag and the age of the saved state in
+            seconds or None if the store of the calendar was never saved.
+        """
+        with self._lock:
+            row = self._db.execute("SELECT sync_token, ctag, saved_at FROM calendars WHERE path = ?",
+                                   (path,)).fetchone()
+            if row is None or row[2] is None:
+                return None
+            rows = self._db.execute("SELECT start, end, all_day, summary, uid, href, etag, recurrence, overrides "
+                                    "FROM events WHERE calendar = ?", (path,)).fetchall()
+        sync_token, ctag, saved_at = row
+        records = [EventRecord(start, end, bool(all_day), summary, uid, href, etag, recurrence,
+                               () if overrides is None else tuple(map(tuple, json.loads(overrides))))
+                   for start, end, all_day, summary, uid, href, etag, recurrence, overrides in rows]
+        return records, sync_token, ctag, max(0.0, time.time() - saved_at)
+
+
+    def save_calendar(self, path: str, sync_token: str, ctag: str, age: float, records, removed):
+        """Saves the changes of an event store since its last save.
+
+        Args:
+            path: A string containing the path of the calendar.
+            sync_token: A string containing the current sync-token of the store.
+            ctag: A string containing the current ctag of the store.
+            age: A float containing the time since the last sync of the store in seconds.
+            records: A list of the added or changed event records.
+            removed: A list of the hrefs of the removed events.
+        """
+        with self._lock, self._transaction():
+            self._db.execute("INSERT INTO calendars (path, sync_token, ctag, saved_at) VALUES (?, ?, ?, ?) "
+                             "ON CONFLICT (path) DO UPDATE SET sync_token = excluded.sync_token, "
+                             "ctag = excluded.ctag, saved_at = excluded.saved_at",
+                             (path, sync_token, ctag, time.time() - age))
+            self._db.executemany("DELETE FROM events WHERE calendar = ? AND href = ?",
+                                 [(path, href) for href in removed])
+            self._db.executemany("INSERT OR REPLACE INTO events (calendar, href, start, end, all_day, summary, uid, "
+                                 "etag, recurrence, overrides) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 [(path, record.href, record.start, record.end, int(record.all_day), record.summary,
+                                   record.uid, record.etag, record.recurrence,
+                                   json.dumps(record.overrides) if len(record.overrides) > 0 else None)
+                                  for record in records])
+
+
+    @contextmanager
+    def _transaction(self):
+        """Runs the block as one transaction, so a crash never leaves half a save in the database."""
+        self._db.execute("BEGIN")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
@@ -0,0 +1,815 @@
+from concurrent.futures import ThreadPoolExecutor
+import heapq
+import threading
+from datetime import datetime, date, time, timedelta, timezone
+from time import monotonic
+from xml.sax.saxutils import escape
+
+import caldav
+from caldav.lib import error
+import requests
+import vobject
+
+from .ical import parse_record, parse_occurrences, UnsupportedEvent
+from .index import EventIndex
+from .names import NameIndex
+from .records import EventRecord
+from .recurrence import RecurrenceExpander
+
+DAV = "{DAV:}"
+CALDAV = "{urn:ietf:params:xml:ns:caldav}"
+CALSERVER = "{http://calendarserver.org/ns/}"
+
+SYNC_COLLECTION = """<?xml version="1.0" encoding="utf-8"?>
+<d:sync-collection xmlns:d="DAV:">
+  <d:sync-token>{token}</d:sync-token>
+  <d:sync-level>1</d:sync-level>
+  <d:prop><d:getetag/></d:prop>
+</d:sync-collection>"""
+
+CALENDAR_MULTIGET = """<?xml version="1.0" encoding="utf-8"?>
+<c:calendar-multiget xmlns:d="DAV:" xmlns:c="urn:ietf:params:xml:ns:caldav">
+  <d:prop><d:getetag/><c:calendar-data/></d:prop>
+  {hrefs}
+</c:calendar-multiget>"""
+
+CTAG_PROPFIND = """<?xml version="1.0" encoding="utf-8"?>
+<d:propfind xmlns:d="DAV:" xmlns:cs="http://calendarserver.org/ns/">
+  <d:prop><cs:getctag/></d:prop>
+</d:propfind>"""
+
+ETAG_PROPFIND = """<?xml version="1.0" encoding="utf-8"?>
+<d:propfind xmlns:d="DAV:">
+  <d:prop><d:getetag/></d:prop>
+</d:propfind>"""
+
+CALENDAR_QUERY = """<?xml version="1.0" encoding="utf-8"?>
+<c:calendar-query xmlns:d="DAV:" xmlns:c="urn:ietf:params:xml:ns:caldav">
+  <d:prop><d:getetag/><c:calendar-data/></d:prop>
+  <c:filter>
+    <c:comp-filter name="VCALENDAR">
+      <c:comp-filter name="VEVENT">
+        {time_range}
+        <c:prop-filter name="SUMMARY">
+          <c:text-match collation="i;unicode-casemap">{text}</c:text-match>
+        </c:prop-filter>
+      </c:comp-filter>
+    </c:comp-filter>
+  </c:filter>
+</c:calendar-query>"""
+
+EXPAND_MULTIGET = """<?xml version="1.0" encoding="utf-8"?>
+<c:calendar-multiget xmlns:d="DAV:" xmlns:c="urn:ietf:params:xml:ns:caldav">
+  <d:prop>
+    <d:getetag/>
+    <c:calendar-data><c:expand start="{start}" end="{end}"/></c:calendar-data>
+  </d:prop>
+  {hrefs}
+</c:calendar-multiget>"""
+
+# number of hrefs fetched with a single calendar-multiget request
+MULTIGET_BATCH = 200
+
+# maximum number of DELETE requests running at the same time
+DELETE_WORKERS = 8
+
+# time ranges around now (days into the past, days into the future) in which events are searched by name on the
+# server, the next range only gets searched if nothing was found in the previous one; None searches without range
+SEARCH_WINDOWS = [(30, 365), (365, 5 * 365), None]
+
+# time span after the given time in which the instances of recurring events are searched for the next events, if
+# there is no later single event, in seconds
+RECURRENCE_HORIZON = 366 * 24 * 3600
+
+
+class WriteRejected(Exception):
+    """Raised if the server refused a write for good, so sending it again won't help."""
+
+
+class EditConflict(WriteRejected):
+    """Raised if an event was changed or deleted on the server while the user was editing it."""
+
+
+def apply_changes(event: caldav.objects.Event, changes: dict):
+    """Applies the changes collected while editing an event to the parsed event object.
+
+    Args:
+        event: The event object.
+        changes: A dict which can contain the new start and end datetime objects and the new name under the keys
+            start, end and name.
+    """
+    vevent = event.instance.vevent
+    if "start" in changes:
+        vevent.dtstart.value = changes["start"]
+    if "end" in changes:
+        if hasattr(vevent, "duration"):
+            del vevent.duration
+        if not hasattr(vevent, "dtend"):
+            vevent.add("dtend")
+        vevent.dtend.value = changes["end"]
+    if "name" in changes:
+        if not hasattr(vevent, "summary"):
+            vevent.add("summary")
+        vevent.summary.value = changes["name"]
+
+
+def edited_fields_changed(event: caldav.objects.Event, original: dict):
+    """Checks whether an event object differs from the version the user edited in the edited attributes.
+
+    Args:
+        event: The event object.
+        original: A dict containing the start and end as utc timestamps and the name the user saw under the keys
+            start, end and name. Only the edited attributes are contained.
+
+    Returns:
+        Boolean telling whether any of the attributes was changed.
+    """
+    record = EventRecord.from_vcalendar(event.instance, "")
+    current = {"start": record.start, "end": record.end, "name": record.summary}
+    return any(current[key] != value for key, value in original.items())
+
+
+def parse_multistatus(tree):
+    """Reads the responses of a multistatus body.
+
+    Args:
+        tree: The parsed xml tree of a multistatus response.
+
+    Returns:
+        A list of tuples containing the href, a boolean telling whether the resource was found and a dict with the
+        text of the found properties by their tag.
+    """
+    responses = []
+    if tree is None:
+        return responses
+    for response in tree.iter(DAV + "response"):
+        href = response.findtext(DAV + "href")
+        status = response.findtext(DAV + "status")
+        found = status is None or " 200 " in status
+        props = {}
+        for propstat in response.iter(DAV + "propstat"):
+            if " 200 " not in (propstat.findtext(DAV + "status") or ""):
+                continue
+            for prop in propstat.find(DAV + "prop"):
+                props[prop.tag] = prop.text
+        responses.append((href, found, props))
+    return responses
+
+
+class EventStore:
+    """A local copy of the events of one calendar.
+
+    The store runs a full sync once and afterwards only pulls the hrefs which have changed or were deleted since the
+    last sync, using the RFC 6578 sync-collection report. Servers without sync-token support are synced by comparing
+    the ctag of the calendar and the etags of its events.
+    The events are stored as compact EventRecords, which are indexed by their start time to answer range queries
+    without scanning the whole calendar and by the words of their names to find misheard names.
+    """
+
+    def __init__(self, session, calendar: caldav.objects.Calendar, log=None):
+        """Inits an empty store, which gets filled on the first sync.
+
+        Args:
+            session: The CalDavSession used for the requests.
+            calendar: The calendar object whose events should get stored.
+            log: Optional; A logger for events which can't be read or expanded.
+        """
+        self.session = session
+        self.log = log
+        self.calendar = calendar
+        self.sync_token = None
+        self.ctag = None
+        self._use_sync_collection = True
+        self.synced_at = None
+        self._records = {}
+        # recurring events aren't indexed by their start, their instances get expanded for every queried time span
+        self._series = {}
+        self._expander = RecurrenceExpander(self._expand_on_server, log=log)
+        self._use_server_expand = True
+        self._index = EventIndex()
+        self._names = NameIndex()
+        # number of writes waiting to be sent by the href of the event, the sync keeps the local version of these
+        self.pending = {}
+        # hrefs of the events added, changed or removed since the last snapshot of the store
+        self._dirty = set()
+        self._lock = threading.RLock()
+
+
+    def events_between(self, start: datetime = None, end: datetime = None):
+        """Finds the stored events starting between start and end.
+
+        Args:
+            start: Optional; A datetime object representing the minimal value for the startdate attribute.
+            end: Optional; A datetime object representing the maximum value for the startdate attribute.
+
+        Returns:
+            A list of event records sorted by their start.
+        """
+        with self._lock:
+            return self._between(None if start is None else start.timestamp(), None if end is None else end.timestamp())
+
+
+    def next_events(self, after: datetime, count: int = 1):
+        """Finds the next stored events starting at or after the given time.
+
+        Args:
+            after: A datetime object representing the minimal value for the startdate attribute.
+            count: Optional; The maximum number of events to return.
+
+        Returns:
+            A list of event records sorted by their start.
+        """
+        with self._lock:
+            start = after.timestamp()
+            records = [self._records[href] for href in self._index.after(start, count)]
+            if len(self._series) > 0:
+                # only instances before the last found single event can be among the next events
+                end = records[-1].start if len(records) == count else start + RECURRENCE_HORIZON
+                with self.session.metrics.span("expand"):
+                    occurrences = self._expander.between(list(self._series.values()), start, end)
+                records = list(heapq.merge(records, occurrences, key=lambda record: record.start))[:count]
+            return records
+
+
+    def earliest_events(self, after: datetime):
+        """Finds all stored events sharing the earliest start at or after the given time.
+
+        Args:
+            after: A datetime object representing the minimal value for the startdate attribute.
+
+        Returns:
+            A list of event records.
+        """
+        with self._lock:
+            records = self.next_events(after)
+            if len(records) == 0:
+                return []
+            return self._between(records[0].start, records[0].start)
+
+
+    def events_on(self, day: date):
+        """Finds the stored events starting at the given day in the local timezone.
+
+        Args:
+            day: A date object representing the day.
+
+        Returns:
+            A list of event records sorted by their start.
+        """
+        return self.events_between(datetime.combine(day, time.min).astimezone(),
+                                   datetime.combine(day, time.max).astimezone())
+
+
+    def _between(self, start: float = None, end: float = None):
+        """Finds the single events and the instances of recurring events starting between start and end.
+
+        Args:
+            start: Optional; A float representing the minimal start as utc timestamp.
+            end: Optional; A float representing the maximum start as utc timestamp.
+
+        Returns:
+            A list of event records sorted by their start.
+        """
+        records = [self._records[href] for href in self._index.between(start, end)]
+        if len(self._series) == 0:
+            return records
+        series = list(self._series.values())
+        if start is None:
+            start = min(record.start for record in series)
+        if end is None:
+            end = max(start, datetime.now().timestamp()) + RECURRENCE_HORIZON
+        with self.session.metrics.span("expand"):
+            occurrences = self._expander.between(series, start, end)
+        return list(heapq.merge(records, occurrences, key=lambda record: record.start))
+
+
+    def sync(self):
+        """Brings the store up to date with the server. Uses the sync-token if the server supports it and falls back
+        to comparing the ctag and etags otherwise.
+        """
+        with self._lock, self.session.metrics.span("sync"):
+            self.session.call(self._sync)
+            self.synced_at = monotonic()
+
+
+    def age(self):
+        """Gets the time passed since the last successful sync.
+
+        Returns:
+            A float containing the age in seconds or None if the store was never synced.
+        """
+        return None if self.synced_at is None else monotonic() - self.synced_at
+
+
+    def sync_if_stale(self, max_age: float):
+        """Syncs the store only if it wasn't synced within the given time, e.g. by the background refresh.
+
+        Args:
+            max_age: A float containing the maximum age of the stored events in seconds.
+        """
+        with self._lock:
+            age = self.age()
+            if age is None or age > max_age:
+                self.sync()
+
+
+    def get(self, href: str):
+        """Gets the stored record of an event.
+
+        Args:
+            href: A string containing the href of the event.
+
+        Returns:
+            The event record or None if the event isn't stored.
+        """
+        with self._lock:
+            return self._records.get(href)
+
+
+    def put(self, record: EventRecord):
+        """Adds an event record to the store or replaces its stored version, e.g. after it was created or modified.
+
+        Args:
+            record: The event record.
+        """
+        with self._lock:
+            self._records[record.href] = record
+            if record.recurring:
+                self._index.remove(record.href)
+                self._series[record.href] = record
+            else:
+                self._series.pop(record.href, None)
+                self._index.add(record.href, record.start)
+            self._names.add(record.href, record.summary_lower)
+            self._dirty.add(record.href)
+
+
+    def put_many(self, records):
+        """Adds many event records at once, e.g. the events downloaded by a sync.
+
+        Args:
+            records: A list of event records.
+        """
+        with self._lock:
+            for record in records:
+                self._records[record.href] = record
+                self._names.add(record.href, record.summary_lower)
+                self._dirty.add(record.href)
+                if record.recurring:
+                    self._index.remove(record.href)
+                    self._series[record.href] = record
+                else:
+                    self._series.pop(record.href, None)
+            self._index.add_many([(record.href, record.start) for record in records if not record.recurring])
+
+
+    def load(self, records, sync_token: str, ctag: str, age: float):
+        """Fills the empty store with the events of a snapshot. The next sync only fetches the changes made since.
+        Events with unsent writes are taken from the snapshot too, since it holds their local version.
+
+        Args:
+            records: A list of event records.
+            sync_token: A string containing the sync-token at the time of the snapshot.
+            ctag: A string containing the ctag at the time of the snapshot.
+            age: A float containing the age of the snapshot in seconds.
+        """
+        with self._lock:
+            self.put_many(records)
+            self._dirty.clear()
+            self.sync_token = sync_token
+            self.ctag = ctag
+            self.synced_at = monotonic() - age
+
+
+    def take_changes(self):
+        """Gets the changes since the last call together with the sync state they belong to, so only these have to be
+        written to the snapshot.
+
+        Returns:
+            A tuple containing the sync-token, the ctag, the age of the store in seconds, the list of added or changed
+            event records and the list of hrefs of removed events.
+        """
+        with self._lock:
+            records = [self._records[href] for href in self._dirty if href in self._records]
+            removed = [href for href in self._dirty if href not in self._records]
+            self._dirty.clear()
+            return self.sync_token, self.ctag, self.age(), records, removed
+
+
+    def open(self, href: str):
+        """Downloads and parses the current full event object to edit it.
+
+        Args:
+            href: A string containing the href of the event.
+
+        Returns:
+            A tuple containing the loaded event object and its etag or None and None if the event doesn't exist
+            anymore.
+
+        Raises:
+            WriteRejected: The server refused to send the event.
+            caldav.lib.error.DAVError: The server failed to send the event for now.
+        """
+        url = self.calendar.url.join(href)
+        response = self._send_write(lambda: self.session.client.request(str(url)), url)
+        if response.status == 404:
+            return None, None
+        if 300 <= response.status < 500:
+            raise WriteRejected(f"{url} was refused: {response.status} {response.reason}")
+        if response.status >= 500:
+            raise error.DAVError(f"Couldn't load {url}: {response.status} {response.reason}")
+        data = response.raw.decode("utf-8") if isinstance(response.raw, bytes) else response.raw
+        return caldav.Event(self.session.client, url=url, data=data, parent=self.calendar), response.headers.get("ETag")
+
+
+    def save(self, href: str, changes: dict, etag: str = None, original: dict = None):
+        """Applies all changes made to an event with a single conditional PUT request. The changes are applied to the
+        current version of the event on the server. If it isn't the version the user edited anymore, the changes are
+        only applied if the edited attributes are still the same, otherwise the edit is refused. The request is
+        retried once, if the event was changed in between. The store gets updated with the etag returned by the
+        server, without loading the event again.
+
+        Args:
+            href: A string containing the href of the edited event.
+            changes: A dict containing the changes, see apply_changes.
+            etag: Optional; A string containing the etag of the version the user edited.
+            original: Optional; A dict containing the values of the edited attributes the user saw, see
+                edited_fields_changed.
+
+        Raises:
+            EditConflict: The event was deleted or its edited attributes were changed on the server.
+        """
+        for _ in range(2):
+            event, current = self.open(href)
+            if event is None:
+                raise EditConflict(f"{href} was deleted")
+            if etag is not None and current is not None and current != etag and original is not None and \
+                    edited_fields_changed(event, original):
+                raise EditConflict(f"{href} was changed while it was edited")
+            apply_changes(event, changes)
+            headers = {"Content-Type": "text/calendar; charset=utf-8"}
+            if current is not None:
+                headers["If-Match"] = current
+            data = event.instance.serialize()
+            response = self._send_write(lambda: self.session.client.put(str(event.url), data, headers), event.url)
+            if response.status < 300:
+                self.put(EventRecord.from_vcalendar(event.instance, href, response.headers.get("ETag")))
+                return
+            if response.status != 412:
+                self._raise_write_error(response, event.url)
+        raise EditConflict(f"{href} was changed while saving it")
+
+
+    def create(self, href: str, data: str):
+        """Creates an event on the server. The request is conditional, so an existing event is never overwritten.
+        The stored record of the event gets the etag returned by the server.
+
+        Args:
+            href: A string containing the href of the new event.
+            data: A string containing the icalendar payload of the event.
+        """
+        url = self.calendar.url.join(href)
+        headers = {"Content-Type": "text/calendar; charset=utf-8", "If-None-Match": "*"}
+        response = self._send_write(lambda: self.session.client.put(str(url), data, headers), url)
+        # 412 means the event exists already, i.e. it was created by an earlier attempt
+        if response.status == 412:
+            return
+        if response.status >= 300:
+            self._raise_write_error(response, url)
+        with self._lock:
+            record = self._records.get(href)
+            if record is not None:
+                record.etag = response.headers.get("ETag")
+                self._dirty.add(href)
+
+
+    def refresh(self, href: str):
+        """Loads a single event again, e.g. after a write to it failed and its local version is wrong.
+
+        Args:
+            href: A string containing the href of the event.
+        """
+        with self._lock:
+            self.session.call(self._fetch, [href])
+
+
+    def hold(self, href: str):
+        """Marks an event as changed locally, so syncs don't replace its local version until it gets released.
+
+        Args:
+            href: A string containing the href of the event.
+        """
+        with self._lock:
+            self.pending[href] = self.pending.get(href, 0) + 1
+
+
+    def release(self, href: str):
+        """Lets syncs update an event again after all of its writes were sent.
+
+        Args:
+            href: A string containing the href of the event.
+        """
+        with self._lock:
+            count = self.pending.pop(href, 0) - 1
+            if count > 0:
+                self.pending[href] = count
+
+
+    def remove(self, href: str):
+        """Removes an event from the store, e.g. after it was deleted on the server.
+
+        Args:
+            href: A string containing the href of the event.
+        """
+        with self._lock:
+            self._records.pop(href, None)
+            self._series.pop(href, None)
+            self._index.remove(href)
+            self._names.remove(href)
+            self._dirty.add(href)
+
+
+    def find(self, name: str):
+        """Finds the stored events whose name is similar to the given name, ignoring the case.
+
+        Args:
+            name: A string containing the name to search for.
+
+        Returns:
+            A list of event records grouped by their name, with the most similar name first. The events with the same
+            name are sorted by their start.
+        """
+        with self._lock:
+            found = []
+            for _, _, hrefs in self._names.search(name):
+                found.extend(sorted((self._records[href] for href in hrefs), key=lambda record: record.start))
+            return found
+
+
+    def search(self, name: str):
+        """Searches the events whose name contains the given name on the server, without syncing the whole calendar.
+        The search starts in a time range around now and only gets widened if nothing is found. The found events are
+        added to the store.
+
+        Args:
+            name: A string containing the name to search for.
+
+        Returns:
+            A list of event records sorted by their start.
+        """
+        now = datetime.now(timezone.utc)
+        for window in SEARCH_WINDOWS:
+            time_range = ""
+            if window is not None:
+                time_range = (f'<c:time-range start="{now - timedelta(days=window[0]):%Y%m%dT%H%M%SZ}" '
+                              f'end="{now + timedelta(days=window[1]):%Y%m%dT%H%M%SZ}"/>')
+            body = CALENDAR_QUERY.format(time_range=time_range, text=escape(name))
+            with self.session.metrics.span("report"):
+                response = self.session.call(lambda: self.session.client.report(str(self.calendar.url), body, 1))
+            records = self._store_responses(response.tree)
+            if len(records) > 0:
+                return sorted(records, key=lambda record: record.start)
+        return []
+
+
+    def delete_many(self, targets):
+        """Deletes multiple events on the server at the same time and removes them from the store afterwards.
+        Every request is conditional on the given etag, so events changed on the server in the meantime are kept.
+
+        Args:
+            targets: A list of tuples containing the href and the etag of the events to delete.
+
+        Returns:
+            A tuple containing the list of the hrefs of the deleted events, the list of hrefs the server refused to
+            delete and the list of hrefs which couldn't be deleted for now, e.g. because the server wasn't reachable.
+        """
+        if len(targets) == 1:
+            results = [self._request_delete(targets[0])]
+        else:
+            with ThreadPoolExecutor(max_workers=min(DELETE_WORKERS, len(targets))) as pool:
+                results = list(pool.map(self._request_delete, targets))
+
+        deleted = [href for (href, _), result in zip(targets, results) if result is True]
+        failed = [href for (href, _), result in zip(targets, results) if result is False]
+        retry = [href for (href, _), result in zip(targets, results) if result is None]
+        with self._lock:
+            for href in deleted:
+                self.remove(href)
+        return deleted, failed, retry
+
+
+    def _request_delete(self, target):
+        """Sends the conditional DELETE request of an event.
+
+        Args:
+            target: A tuple containing the href and the etag of the event to delete.
+
+        Returns:
+            True if the event is gone from the server, False if the server refused to delete it and None if the
+            request failed and should be sent again later.
+        """
+        href, etag = target
+        headers = {} if etag is None else {"If-Match": etag}
+        try:
+            response = self.session.call(lambda: self.session.client.request(
+                str(self.calendar.url.join(href)), "DELETE", "", headers))
+        except error.AuthorizationError:
+            # still refused after connecting again, e.g. the calendar is read-only for the user
+            return False
+        except (requests.exceptions.RequestException, error.DAVError) as e:
+            if self.log is not None:
+                self.log.warning(f"Couldn't delete {href}, trying again later: {e}")
+            return None
+        # 404 means someone else deleted the event already, 412 that it was changed since it was stored
+        if response.status < 300 or response.status == 404:
+            return True
+        if response.status >= 500:
+            if self.log is not None:
+                self.log.warning(f"Couldn't delete {href}, trying again later: {response.status} {response.reason}")
+            return None
+        return False
+
+
+    def _send_write(self, request, url):
+        """Sends a write request with the session. The client raises refused authorizations before the response can
+        be checked, for a write they mean the calendar is read-only for the user, which won't change by retrying.
+
+        Raises:
+            WriteRejected: The server refused the authorization even after connecting again.
+        """
+        try:
+            return self.session.call(request)
+        except error.AuthorizationError as e:
+            raise WriteRejected(f"{url} was refused: {getattr(e, 'reason', None) or 'not authorized'}")
+
+
+    @staticmethod
+    def _raise_write_error(response, url):
+        """Raises the error matching the status of a failed write request.
+
+        Raises:
+            WriteRejected: The server refused the write.
+            caldav.lib.error.PutError: The server failed to handle the write for now.
+        """
+        if response.status < 500:
+            raise WriteRejected(f"{url} was refused: {response.status} {response.reason}")
+        raise error.PutError(f"Couldn't write {url}: {response.status} {response.reason}")
+
+
+    def _sync(self):
+        if self._use_sync_collection:
+            try:
+                with self.session.metrics.span("report"):
+                    response = self.session.client.report(str(self.calendar.url),
+                                                          SYNC_COLLECTION.format(token=escape(self.sync_token or "")),
+                                                          1)
+            except error.AuthorizationError:
+                # servers answer an invalid sync-token with 403, which the client takes for an authorization error
+                if self.sync_token is None:
+                    raise
+                response = None
+            if response is not None and response.status == 207:
+                self._apply_sync_collection(response.tree, self.sync_token is None)
+                return
+            # either the token expired or the server doesn't support sync-collection at all
+            self._use_sync_collection = self.sync_token is not None
+            self.sync_token = None
+        self._sync_by_ctag()
+
+
+    def _apply_sync_collection(self, tree, initial: bool = False):
+        changed = []
+        listed = set()
+        for href, found, props in parse_multistatus(tree):
+            if href is None or href.endswith("/") or href in self.pending:
+                continue
+            listed.add(href)
+            if not found:
+                self.remove(href)
+            elif href not in self._records or props.get(DAV + "getetag") != self._records[href].etag:
+                changed.append(href)
+        if initial:
+            # a sync without token lists the existing events only, events loaded from a snapshot may be gone since
+            for href in set(self._records) - listed - set(self.pending):
+                self.remove(href)
+        self._fetch(changed)
+        self.sync_token = tree.findtext(DAV + "sync-token")
+
+
+    def _sync_by_ctag(self):
+        with self.session.metrics.span("propfind"):
+            response = self.session.client.propfind(str(self.calendar.url), CTAG_PROPFIND, 0)
+        props = parse_multistatus(response.tree)[0][2] if response.status == 207 else {}
+        ctag = props.get(CALSERVER + "getctag")
+        if ctag is not None and ctag == self.ctag:
+            return
+
+        with self.session.metrics.span("propfind"):
+            response = self.session.client.propfind(str(self.calendar.url), ETAG_PROPFIND, 1)
+        etags = {href: props.get(DAV + "getetag") for href, found, props in parse_multistatus(response.tree)
+                 if found and href is not None and not href.endswith("/")}
+        for href in set(self._records) - set(etags) - set(self.pending):
+            self.remove(href)
+        self._fetch([href for href, etag in etags.items() if href not in self.pending and
+                     (href not in self._records or etag is None or etag != self._records[href].etag)])
+        self.ctag = ctag
+
+
+    def _fetch(self, hrefs):
+        """Downloads the given events with calendar-multiget reports and stores their records.
+
+        Args:
+            hrefs: A list of strings containing the hrefs of the events.
+        """
+        client = self.session.client
+        for i in range(0, len(hrefs), MULTIGET_BATCH):
+            body = CALENDAR_MULTIGET.format(hrefs="".join(f"<d:href>{escape(href)}</d:href>"
+                                                          for href in hrefs[i:i + MULTIGET_BATCH]))
+            with self.session.metrics.span("report"):
+                response = client.report(str(self.calendar.url), body, 1)
+            self._store_responses(response.tree)
+
+
+    def _store_responses(self, tree):
+        """Stores the records of the events contained in a multistatus response with calendar-data.
+
+        Args:
+            tree: The parsed xml tree of the response.
+
+        Returns:
+            A list of the stored event records.
+        """
+        records = []
+        with self.session.metrics.span("parse"):
+            for href, found, props in parse_multistatus(tree):
+                data = props.get(CALDAV + "calendar-data")
+                if href in self.pending:
+                    continue
+                if not found or data is None:
+                    self.remove(href)
+                else:
+                    record = self._read_record(data, href, props.get(DAV + "getetag"))
+                    if record is not None:
+                        records.append(record)
+        self.put_many(records)
+        return records
+
+
+    def _expand_on_server(self, start: float, end: float):
+        """Lets the server expand the instances of the recurring events in a time span.
+
+        Args:
+            start: A float representing the start of the time span as utc timestamp.
+            end: A float representing the end of the time span as utc timestamp.
+
+        Returns:
+            A dict containing a tuple of the etag and the list of instances in the time span by the href of every
+            recurring event or None if the server can't expand them.
+        """
+        if not self._use_server_expand:
+            return None
+        # only the recurring events are requested, the single events in the time span are stored already
+        hrefs = list(self._series)
+        expanded = {}
+        for i in range(0, len(hrefs), MULTIGET_BATCH):
+            body = EXPAND_MULTIGET.format(start=f"{datetime.fromtimestamp(start, timezone.utc):%Y%m%dT%H%M%SZ}",
+                                          end=f"{datetime.fromtimestamp(end, timezone.utc):%Y%m%dT%H%M%SZ}",
+                                          hrefs="".join(f"<d:href>{escape(href)}</d:href>"
+                                                        for href in hrefs[i:i + MULTIGET_BATCH]))
+            with self.session.metrics.span("report"):
+                response = self.session.call(lambda: self.session.client.report(str(self.calendar.url), body, 1))
+            if response.status != 207:
+                self._use_server_expand = False
+                return None
+            for href, found, props in parse_multistatus(response.tree):
+                data = props.get(CALDAV + "calendar-data")
+                if not found or data is None or href not in self._series:
+                    continue
+                try:
+                    occurrences = parse_occurrences(data)
+                except ValueError:
+                    # without etag the event gets expanded on the device
+                    expanded[href] = (None, [])
+                    continue
+                if occurrences is None:
+                    # the server ignored the expand element and sent the recurrence rules
+                    self._use_server_expand = False
+                    return None
+                expanded[href] = (props.get(DAV + "getetag"), occurrences)
+        return expanded
+
+
+    def _read_record(self, data: str, href: str, etag: str):
+        """Creates the record of a downloaded event. Only the needed properties are read from the payload, the
+        complete vobject tree is built only for events the fast parser can't handle. Malformed events are skipped, so
+        they don't keep the rest of the calendar from being synced.
+        """
+        try:
+            try:
+                return parse_record(data, href, etag)
+            except UnsupportedEvent:
+                return EventRecord.from_vcalendar(vobject.readOne(data), href, etag)
+        except (ValueError, vobject.base.VObjectError):
+            if self.log is not None:
+                self.log.exception(f"Skipping the malformed event {href}")
+            return None
@@ -0,0 +1,86 @@
+from datetime import date, datetime, timedelta
+
+from dateutil import tz
+import pytest
+import vobject
+
+from nextcalendar.ical import (UnsupportedEvent, parse_date_value, parse_duration, parse_occurrences, parse_record,
+                               unescape_text, unfolded_lines)
+from nextcalendar.records import EventRecord
+from nextcalendar.recurrence import expand
+
+HREF = "/calendars/user/personal/event.ics"
+
+
+def calendar(*lines):
+    return "\r\n".join(["BEGIN:VCALENDAR", "VERSION:2.0", *lines, "END:VCALENDAR", ""])
+
+
+def event(*lines):
+    return ["BEGIN:VEVENT", "UID:event-1", "DTSTAMP:20260101T000000Z", *lines, "END:VEVENT"]
+
+
+PAYLOADS = {
+    "utc": calendar(*event("DTSTART:20261020T100000Z", "DTEND:20261020T113000Z", "SUMMARY:Dentist")),
+    "zoned": calendar(*event("DTSTART;TZID=Europe/Berlin:20261020T100000",
+                             "DTEND;TZID=Europe/Berlin:20261020T110000", "SUMMARY:Team meeting")),
+    "floating": calendar(*event("DTSTART:20261020T100000", "DURATION:PT1H30M", "SUMMARY:Gym")),
+    "all day": calendar(*event("DTSTART;VALUE=DATE:20261020", "SUMMARY:Birthday")),
+    "folded and escaped": calendar(*event("DTSTART:20261020T100000Z", "DTEND:20261020T110000Z",
+                                          "SUMMARY:Lunch\\, with Alex\\; and the team",
+                                          " at the new place",
+                                          "BEGIN:VALARM", "ACTION:DISPLAY", "TRIGGER:-PT15M", "SUMMARY:Alarm",
+                                          "END:VALARM")),
+    "recurring": calendar(*event("DTSTART;TZID=Europe/Berlin:20260302T100000",
+                                 "DTEND;TZID=Europe/Berlin:20260302T110000", "RRULE:FREQ=WEEKLY;COUNT=20",
+                                 "EXDATE;TZID=Europe/Berlin:20260309T100000", "SUMMARY:Weekly"),
+                          "BEGIN:VEVENT", "UID:event-1", "RECURRENCE-ID;TZID=Europe/Berlin:20260316T100000",
+                          "DTSTART;TZID=Europe/Berlin:20260316T120000", "DTEND;TZID=Europe/Berlin:20260316T130000",
+                          "SUMMARY:Weekly moved", "END:VEVENT"),
+}
+
+
+def test_folded_lines_are_joined():
+    assert list(unfolded_lines("SUMMARY:Lunch with\r\n  Alex\r\n\t and Bob\r\nUID:1\r\n")) == \
+        ["SUMMARY:Lunch with Alex and Bob", "UID:1"]
+
+
+def test_dates_and_durations_are_parsed():
+    assert parse_date_value("20261020", {"VALUE": "DATE"}) == date(2026, 10, 20)
+    assert parse_date_value("20261020T100000Z", {}) == datetime(2026, 10, 20, 10, tzinfo=tz.UTC)
+    assert parse_date_value("20261020T100000", {}) == datetime(2026, 10, 20, 10)
+    zoned = parse_date_value("20261020T100000", {"TZID": "Europe/Berlin"})
+    assert zoned.utcoffset() == timedelta(hours=2)
+    assert parse_duration("-P1W2DT3H4M5S") == -timedelta(weeks=1, days=2, hours=3, minutes=4, seconds=5)
+    assert unescape_text("a\\,b\\;c\\\\d\\ne") == "a,b;c\\d\ne"
+
+
+def test_unknown_timezone_and_invalid_duration_need_a_full_parse():
+    with pytest.raises(UnsupportedEvent):
+        parse_date_value("20261020T100000", {"TZID": "W. Europe Standard Time"})
+    with pytest.raises(UnsupportedEvent):
+        parse_duration("1 hour")
+
+
+@pytest.mark.parametrize("name", sorted(PAYLOADS))
+def test_record_matches_the_one_read_by_vobject(name):
+    data = PAYLOADS[name]
+    parsed = parse_record(data, HREF, '"1"')
+    full = EventRecord.from_vcalendar(vobject.readOne(data), HREF, '"1"')
+
+    for field in ("start", "end", "all_day", "summary", "summary_lower", "uid", "href", "etag", "overrides"):
+        assert getattr(parsed, field) == getattr(full, field), field
+    assert parsed.recurring == full.recurring
+    if parsed.recurring:
+        start, end = datetime(2026, 3, 1).timestamp(), datetime(2026, 8, 1).timestamp()
+        assert expand(parsed, start, end) == expand(full, start, end)
+
+
+def test_events_of_expanded_payloads_are_read():
+    data = calendar(*event("DTSTART:20261020T100000Z", "DTEND:20261020T110000Z", "SUMMARY:Weekly"),
+                    *event("DTSTART:20261027T100000Z", "DTEND:20261027T110000Z", "SUMMARY:Weekly moved"))
+    start = datetime(2026, 10, 20, 10, tzinfo=tz.UTC).timestamp()
+
+    assert parse_occurrences(data) == [(start, start + 3600, "Weekly"),
+                                       (start + 7 * 86400, start + 7 * 86400 + 3600, "Weekly moved")]
+    assert parse_occurrences(PAYLOADS["recurring"]) is None
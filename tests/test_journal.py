@@ -0,0 +1,91 @@
+import logging
+import threading
+import time
+
+import pytest
+
+from nextcalendar import journal
+from nextcalendar.journal import DONE, RETRY, WriteQueue
+
+CALENDAR = "https://cloud.example.com/remote.php/dav/calendars/user/personal/"
+
+
+class Server:
+    """Answers the sent writes with the scripted results and records the batches."""
+
+    def __init__(self, results=()):
+        self.results = list(results)
+        self.batches = []
+
+    def send(self, writes):
+        self.batches.append([(write.kind, write.href, write.attempts) for write in writes])
+        return [self.results.pop(0) if self.results else DONE for _ in writes]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "writes.db")
+
+
+def drain(queue: WriteQueue):
+    for _ in range(500):
+        if len(queue.pending(CALENDAR)) == 0:
+            return
+        threading.Event().wait(0.01)
+    raise AssertionError("The writes weren't sent")
+
+
+def test_writes_survive_a_restart(path):
+    queue = WriteQueue(path, Server().send)
+    queue.push(CALENDAR, "create", "/a.ics", {"data": "BEGIN:VCALENDAR"})
+    queue.stop()
+
+    server = Server()
+    queue = WriteQueue(path, server.send)
+    assert queue.pending(CALENDAR) == {"/a.ics": 1}
+    queue.start()
+    drain(queue)
+    queue.stop()
+
+    assert server.batches == [[("create", "/a.ics", 0)]]
+
+
+def test_writes_of_an_event_are_sent_in_order(path):
+    server = Server()
+    queue = WriteQueue(path, server.send)
+    queue.push(CALENDAR, "create", "/a.ics", {})
+    queue.push(CALENDAR, "modify", "/a.ics", {})
+    queue.push(CALENDAR, "create", "/b.ics", {})
+    queue.start()
+    drain(queue)
+    queue.stop()
+
+    assert server.batches == [[("create", "/a.ics", 0), ("create", "/b.ics", 0)], [("modify", "/a.ics", 0)]]
+
+
+def test_writes_pushed_together_are_sent_together(path):
+    server = Server()
+    queue = WriteQueue(path, server.send)
+    queue.start()
+    queue.push_many(CALENDAR, "delete", [(f"/{i}.ics", {"etag": f'"{i}"'}) for i in range(5)])
+    drain(queue)
+    queue.stop()
+
+    assert server.batches == [[("delete", f"/{i}.ics", 0) for i in range(5)]]
+
+
+def test_failing_write_is_retried_with_backoff_and_given_up(path, monkeypatch, caplog):
+    monkeypatch.setattr(journal, "RETRY_DELAY", 0.01)
+    monkeypatch.setattr(journal, "MAX_ATTEMPTS", 3)
+    server = Server([RETRY] * 3)
+    queue = WriteQueue(path, server.send, logging.getLogger("journal"))
+    queue.push(CALENDAR, "modify", "/a.ics", {})
+    started = time.monotonic()
+    queue.start()
+    drain(queue)
+    queue.stop()
+
+    assert server.batches == [[("modify", "/a.ics", attempt)] for attempt in range(3)]
+    # the delays double: 0.01 and 0.02 seconds
+    assert time.monotonic() - started >= 0.03
+    assert "Giving up to modify /a.ics after 3 attempts" in caplog.text
@@ -0,0 +1,25 @@
+from nextcalendar.names import NameIndex
+
+TOPICS = ["Team meeting", "Lunch with Alex", "Project review", "Gym", "Parents evening"]
+
+
+def test_misheard_name_is_found_among_many_names_sharing_its_trigrams():
+    index = NameIndex()
+    for i in range(10000):
+        index.add(f"/events/{i}.ics", f"{TOPICS[i % len(TOPICS)]} {i}".lower())
+
+    found = index.search("project reveiw")
+
+    assert len(found) == 5
+    assert all(name.startswith("project review") for name, _, _ in found)
+
+
+def test_removed_names_are_not_found():
+    index = NameIndex()
+    index.add("/events/1.ics", "dentist")
+    index.add("/events/2.ics", "dentist appointment")
+    index.add("/events/2.ics", "doctor")
+    index.remove("/events/1.ics")
+
+    assert index.search("dentist") == []
+    assert [name for name, _, _ in index.search("doktor")] == ["doctor"]
@@ -0,0 +1,48 @@
+from datetime import datetime, timedelta, timezone
+
+from dateutil import tz
+import vobject
+
+from nextcalendar.ical import parse_record
+from nextcalendar.records import EventRecord, format_date_line
+from nextcalendar.recurrence import expand
+
+BERLIN = tz.gettz("Europe/Berlin")
+WEEKLY = """BEGIN:VCALENDAR
+VERSION:2.0
+BEGIN:VEVENT
+UID:weekly
+DTSTART;TZID=Europe/Berlin:20260302T100000
+DTEND;TZID=Europe/Berlin:20260302T110000
+RRULE:FREQ=WEEKLY
+EXDATE;TZID=Europe/Berlin:20260608T100000
+SUMMARY:Weekly meeting
+END:VEVENT
+END:VCALENDAR
+"""
+
+
+def test_zoned_recurrence_keeps_its_time_across_daylight_saving_time():
+    parsed = parse_record(WEEKLY, "/weekly.ics")
+    record = EventRecord.from_vcalendar(vobject.readOne(WEEKLY), "/weekly.ics")
+    start = datetime(2026, 6, 1, tzinfo=BERLIN).timestamp()
+    end = datetime(2026, 7, 1, tzinfo=BERLIN).timestamp()
+
+    instances = expand(record, start, end)
+
+    assert [datetime.fromtimestamp(instance[0], BERLIN).strftime("%d %H:%M") for instance in instances] == \
+        ["01 10:00", "15 10:00", "22 10:00", "29 10:00"]
+    assert instances == expand(parsed, start, end)
+
+
+def test_date_lines_keep_their_kind_of_time():
+    day = datetime(2026, 7, 1, 10)
+    assert format_date_line("DTSTART", [day.date()]) == "DTSTART;VALUE=DATE:20260701"
+    assert format_date_line("DTSTART", [day]) == "DTSTART:20260701T100000"
+    assert format_date_line("EXDATE", [day.replace(tzinfo=BERLIN), day.replace(tzinfo=timezone.utc)]) == \
+        "EXDATE;TZID=Europe/Berlin:20260701T100000,20260701T120000"
+    # a local time is floating, unless the device runs in utc
+    local = day.astimezone()
+    assert format_date_line("DTSTART", [local]) == "DTSTART:20260701T100000" + ("" if local.utcoffset() else "Z")
+    assert format_date_line("DTSTART", [day.replace(tzinfo=timezone(timedelta(hours=-11)))]) == \
+        "DTSTART:20260701T210000Z"
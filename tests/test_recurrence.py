@@ -0,0 +1,39 @@
+from datetime import date, datetime, timedelta
+
+from nextcalendar.records import EventRecord, to_timestamp
+from nextcalendar.recurrence import MEMO_SIZE, WINDOW, RecurrenceExpander
+
+
+def birthday(i: int):
+    day = date(2021, 1, 1) + timedelta(days=i * 365 // 400)
+    return EventRecord(to_timestamp(day), to_timestamp(day + timedelta(days=1)), True, f"Birthday {i}",
+                       f"birthday-{i}", f"/calendars/bench/birthdays/{i}.ics", '"1"',
+                       f"DTSTART;VALUE=DATE:{day:%Y%m%d}\nRRULE:FREQ=YEARLY")
+
+
+def test_query_needing_more_windows_than_the_memo_keeps_all_instances():
+    records = [birthday(i) for i in range(400)]
+    start = datetime.now().timestamp()
+    end = start + 366 * 24 * 3600
+    assert len(records) * ((end - start) // WINDOW + 1) > MEMO_SIZE
+
+    expander = RecurrenceExpander()
+    found = expander.between(records, start, end)
+
+    assert {occurrence.uid for occurrence in found} == {record.uid for record in records}
+    assert all(start <= occurrence.start <= end for occurrence in found)
+    # a second query gets the same instances, partly from the memo
+    assert [occurrence.start for occurrence in expander.between(records, start, end)] == \
+        [occurrence.start for occurrence in found]
+
+
+def test_malformed_recurrence_keeps_only_the_first_instance():
+    valid = birthday(0)
+    record = EventRecord(valid.start, valid.end, True, valid.summary, valid.uid, valid.href, valid.etag,
+                         valid.recurrence + "\nEXDATE;VALUE=DATE:2022")
+    start = record.start - 3600
+    end = record.start + 2 * 365 * 24 * 3600
+
+    found = RecurrenceExpander().between([record], start, end)
+
+    assert [occurrence.start for occurrence in found] == [record.start]
@@ -0,0 +1,91 @@
+import sqlite3
+
+import pytest
+
+from nextcalendar.records import EventRecord
+from nextcalendar.snapshot import Snapshot
+from nextcalendar.store import EventStore
+
+HOME = "/nc/remote.php/dav/calendars/user/"
+PERSONAL = HOME + "personal/"
+WORK = HOME + "work/"
+
+
+def fields(record: EventRecord):
+    return tuple(getattr(record, name) for name in EventRecord.__slots__)
+
+
+def records():
+    return [EventRecord(1790000000.0, 1790003600.0, False, "Dentist", "dentist", PERSONAL + "dentist.ics", '"1"'),
+            EventRecord(1790000000.0, 1790086400.0, True, "Standup", "standup", PERSONAL + "standup.ics", '"2"',
+                        "DTSTART;VALUE=DATE:20260921\nRRULE:FREQ=DAILY",
+                        ((1790172800.0, 1790176400.0, "Standup moved"), (1790259200.0, 1790262800.0, None)))]
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "snapshot.db")
+
+
+def test_saved_calendars_and_events_are_loaded_after_a_restart(path):
+    snapshot = Snapshot(path)
+    snapshot.save_discovery("/principals/user/", HOME, {"Personal": PERSONAL, "Work": WORK})
+    snapshot.save_calendar(PERSONAL, "token-1", '"ctag-1"', 60.0, records(), [])
+    snapshot.close()
+
+    snapshot = Snapshot(path)
+    assert snapshot.load_discovery() == ("/principals/user/", HOME, {"Personal": PERSONAL, "Work": WORK})
+    loaded, sync_token, ctag, age = snapshot.load_calendar(PERSONAL)
+    assert sorted(map(fields, loaded)) == sorted(map(fields, records()))
+    assert (sync_token, ctag) == ("token-1", '"ctag-1"')
+    assert 60.0 <= age < 70.0
+    # a calendar whose store was never saved isn't restored
+    assert snapshot.load_calendar(WORK) is None
+    snapshot.close()
+
+
+def test_only_the_changes_are_saved_again(path):
+    snapshot = Snapshot(path)
+    snapshot.save_calendar(PERSONAL, "token-1", None, 0.0, records(), [])
+    renamed = records()[0].occurrence(1790000000.0, summary="Dentist appointment")
+    snapshot.save_calendar(PERSONAL, "token-2", None, 0.0, [renamed], [PERSONAL + "standup.ics"])
+
+    loaded, sync_token, _, _ = snapshot.load_calendar(PERSONAL)
+    assert [record.summary for record in loaded] == ["Dentist appointment"]
+    assert sync_token == "token-2"
+    snapshot.close()
+
+
+def test_calendars_gone_from_the_discovery_are_dropped_with_their_events(path):
+    snapshot = Snapshot(path)
+    snapshot.save_discovery(None, HOME, {"Personal": PERSONAL, "Work": WORK})
+    snapshot.save_calendar(WORK, "token-1", None, 0.0, records(), [])
+    snapshot.save_discovery(None, HOME, {"Personal": PERSONAL})
+
+    assert snapshot.load_discovery() == (None, HOME, {"Personal": PERSONAL})
+    assert snapshot.load_calendar(WORK) is None
+    snapshot.close()
+
+
+def test_snapshot_of_an_other_version_is_dropped(path):
+    snapshot = Snapshot(path)
+    snapshot.save_discovery(None, HOME, {"Personal": PERSONAL})
+    snapshot.save_calendar(PERSONAL, "token-1", None, 0.0, records(), [])
+    snapshot.close()
+    db = sqlite3.connect(path)
+    db.execute("PRAGMA user_version = 0")
+    db.close()
+
+    snapshot = Snapshot(path)
+    assert snapshot.load_discovery() is None
+    assert snapshot.load_calendar(PERSONAL) is None
+    snapshot.close()
+
+
+def test_store_keeps_the_loaded_events_with_unsent_writes(path):
+    store = EventStore(None, None)
+    store.pending[PERSONAL + "dentist.ics"] = 1
+    store.load(records(), "token-1", None, 0.0)
+
+    assert store.get(PERSONAL + "dentist.ics").summary == "Dentist"
+    assert [record.uid for record in store.take_changes()[3]] == []